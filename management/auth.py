@@ -1,23 +1,105 @@
-import base64, hmac, json, secrets
+import base64, hashlib, hmac, json, os, secrets, sqlite3, threading, time
 from datetime import timedelta
 
 from expiringdict import ExpiringDict
 
-import utils
-from mailconfig import get_mail_password, get_mail_user_privileges
+from mailconfig import get_mail_password, get_mail_user_privileges, get_database_version, verify_password
 from mfa import get_hash_mfa_state, validate_auth_mfa
 
 DEFAULT_KEY_PATH   = '/var/lib/mailinabox/api.key'
 DEFAULT_AUTH_REALM = 'Mail-in-a-Box Management Server'
+DEFAULT_SESSIONS_PATH = '/var/lib/mailinabox/sessions.sqlite'
+
+class SQLiteSessionStore:
+	"""A dict-like store of sessions in a SQLite database so that all of the
+	daemon's worker processes see the same sessions. Like ExpiringDict, an
+	entry expires max_age_seconds after it was last set. Expired entries are
+	deleted every so often when a session is set."""
+
+	sweep_interval = 600
+
+	def __init__(self, path, max_age_seconds):
+		self.path = path
+		self.max_age_seconds = max_age_seconds
+		self.local = threading.local()
+		self.last_sweep = 0
+
+		# Session keys are as good as passwords, so keep the file private.
+		# Also, only session key hashes are stored.
+		os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+		conn = self.connect()
+		conn.execute("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+		conn.commit()
+
+	def connect(self):
+		# Use one connection per thread, and a new one after a fork.
+		conn = getattr(self.local, "conn", None)
+		if conn is None or self.local.pid != os.getpid():
+			# Only the management daemon uses this database, so unlike users.sqlite
+			# it can use WAL so that readers don't wait on writers.
+			conn = sqlite3.connect(self.path, timeout=15)
+			conn.execute("PRAGMA journal_mode=WAL")
+			conn.execute("PRAGMA synchronous=NORMAL")
+			self.local.conn = conn
+			self.local.pid = os.getpid()
+		return conn
+
+	@staticmethod
+	def hash_key(key):
+		return hashlib.sha256(key.encode("utf8")).hexdigest()
+
+	def get(self, key, default=None):
+		row = self.connect().execute("SELECT value FROM sessions WHERE key=? AND expires>?", (self.hash_key(key), time.time())).fetchone()
+		if row is None:
+			return default
+		return json.loads(row[0])
+
+	def __contains__(self, key):
+		return self.get(key) is not None
+
+	def __getitem__(self, key):
+		value = self.get(key)
+		if value is None:
+			raise KeyError(key)
+		return value
+
+	def __setitem__(self, key, value):
+		now = time.time()
+		conn = self.connect()
+		with conn:
+			conn.execute("INSERT OR REPLACE INTO sessions (key, value, expires) VALUES (?, ?, ?)",
+				(self.hash_key(key), json.dumps(value), now + self.max_age_seconds))
+			if now - self.last_sweep > self.sweep_interval:
+				conn.execute("DELETE FROM sessions WHERE expires<=?", (now,))
+				self.last_sweep = now
+
+	def __delitem__(self, key):
+		conn = self.connect()
+		with conn:
+			conn.execute("DELETE FROM sessions WHERE key=?", (self.hash_key(key),))
 
 class AuthService:
-	def __init__(self):
+	def __init__(self, sessions_path=DEFAULT_SESSIONS_PATH):
 		self.auth_realm = DEFAULT_AUTH_REALM
 		self.key_path = DEFAULT_KEY_PATH
 		self.max_session_duration = timedelta(days=2)
 
 		self.init_system_api_key()
-		self.sessions = ExpiringDict(max_len=64, max_age_seconds=self.max_session_duration.total_seconds())
+
+		# Sessions are kept in a database shared by all of the daemon's worker
+		# processes. With sessions_path=None, they're kept in this process only,
+		# which only works with a single worker (e.g. when debugging). Any object
+		# that acts like a dict can be used instead by setting self.sessions.
+		if sessions_path:
+			self.sessions = SQLiteSessionStore(sessions_path, self.max_session_duration.total_seconds())
+		else:
+			self.sessions = ExpiringDict(max_len=1024, max_age_seconds=self.max_session_duration.total_seconds())
+
+		# The control panel makes many API calls per page, and each one needs the
+		# user's password state token and privileges. Cache them briefly. Entries
+		# are also dropped as soon as the users database changes (e.g. a password,
+		# privilege or MFA change), see get_user_auth_state.
+		self.user_auth_state = ExpiringDict(max_len=256, max_age_seconds=30)
 
 	def init_system_api_key(self):
 		"""Write an API key to a local file so local processes can use the API"""
@@ -86,8 +168,9 @@ class AuthService:
 		# point we know the email address is a valid user --- unless the user has been
 		# deleted after the session was granted. On error the call will return a tuple
 		# of an error message and an HTTP status code.
-		privs = get_mail_user_privileges(username, env)
+		privs = self.get_user_auth_state(username, env)["privileges"]
 		if isinstance(privs, tuple): raise ValueError(privs[0])
+		privs = list(privs)
 
 		# Return the authorization information.
 		return (username, privs)
@@ -107,14 +190,12 @@ class AuthService:
 			# if an email address is valid.
 			pw_hash = get_mail_password(email, env)
 
-			# Use 'doveadm pw' to check credentials. doveadm will return
-			# a non-zero exit status if the credentials are no good,
-			# and check_call will raise an exception in that case.
-			utils.shell('check_call', [
-				"/usr/bin/doveadm", "pw",
-				"-p", pw,
-				"-t", pw_hash,
-				])
+			# Check the credentials. This is done in-process for the
+			# SHA512-CRYPT hashes we store and falls back to 'doveadm pw'
+			# for other schemes.
+			if not verify_password(pw, pw_hash):
+				msg = "Incorrect password."
+				raise ValueError(msg)
 		except:
 			# Login failed.
 			msg = "Incorrect email address or password."
@@ -139,12 +220,28 @@ class AuthService:
 		hash_key = self.key.encode('ascii')
 		return hmac.new(hash_key, msg, digestmod="sha256").hexdigest()
 
+	def get_user_auth_state(self, email, env):
+		# Returns the user's password state token and privileges, from the cache
+		# if nothing in the users database has changed since they were read.
+		# Raises a ValueError if the user does not exist, like
+		# create_user_password_state_token.
+		db_version = get_database_version(env)
+		cached = self.user_auth_state.get(email)
+		if cached is not None and cached[0] == db_version:
+			return cached[1]
+		state = {
+			"password_token": self.create_user_password_state_token(email, env),
+			"privileges": get_mail_user_privileges(email, env),
+		}
+		self.user_auth_state[email] = (db_version, state)
+		return state
+
 	def create_session_key(self, username, env, type=None):
 		# Create a new session.
 		token = secrets.token_hex(32)
 		self.sessions[token] = {
 			"email": username,
-			"password_token": self.create_user_password_state_token(username, env),
+			"password_token": self.get_user_auth_state(username, env)["password_token"],
 			"type": type,
 		}
 		return token
@@ -154,5 +251,5 @@ class AuthService:
 		session = self.sessions[session_key]
 		if session_type == "login" and session["email"] != user_email: return None
 		if session["type"] != session_type: return None
-		if session["password_token"] != self.create_user_password_state_token(session["email"], env): return None
+		if session["password_token"] != self.get_user_auth_state(session["email"], env)["password_token"]: return None
 		return session
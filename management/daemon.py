@@ -10,18 +10,18 @@
 # DEBUG=1 management/daemon.py
 # service mailinabox start # when done debugging, start it up again
 
-import os, os.path, re, json, time
+import os, os.path, re, json, time, threading
 import multiprocessing.pool
 
 from functools import wraps
 
 from flask import Flask, request, render_template, Response, send_from_directory, make_response
 
-import auth, utils
-from mailconfig import get_mail_users, get_mail_users_ex, get_admins, add_mail_user, set_mail_password, remove_mail_user
+import auth, jobs, utils
+from mailconfig import get_mail_users, get_mail_users_ex, get_admins, add_mail_user, set_mail_password, remove_mail_user, bulk_update_mail_users
 from mailconfig import get_mail_user_privileges, add_remove_mail_user_privilege
-from mailconfig import get_mail_aliases, get_mail_aliases_ex, get_mail_domains, add_mail_alias, remove_mail_alias
-from mailconfig import get_mail_quota, set_mail_quota
+from mailconfig import get_mail_aliases, get_mail_aliases_ex, get_mail_domains, add_mail_alias, remove_mail_alias, bulk_update_mail_aliases
+from mailconfig import get_mail_quota, set_mail_quota, release_database, start_warming_mailbox_usage_cache
 from mfa import get_public_mfa_state, provision_totp, validate_totp_secret, enable_mfa, disable_mfa
 import contextlib
 
@@ -29,6 +29,8 @@ env = utils.load_environment()
 
 auth_service = auth.AuthService()
 
+job_queue = jobs.JobQueue()
+
 # We may deploy via a symbolic link, which confuses flask's template finding.
 me = __file__
 with contextlib.suppress(OSError):
@@ -105,9 +107,24 @@ def authorized_personnel_only(viewfunc):
 def unauthorized(error):
 	return auth_service.make_unauthorized_response()
 
+@app.teardown_request
+def release_database_after_request(exception):
+	# The users database connection is reused across requests. Don't let
+	# a request that failed midway leave a transaction open on it.
+	release_database()
+
 def json_response(data, status=200):
 	return Response(json.dumps(data, indent=2, sort_keys=True)+'\n', status=status, mimetype='application/json')
 
+def is_job_request():
+	# Long-running operations are run as a background job if the client
+	# passes async=1. The response then has the job ID to poll at /system/jobs/<id>.
+	return request.values.get('async', '') == '1'
+
+def submit_job(name, func, *args, **kwargs):
+	job_id = job_queue.submit(name, func, *args, **kwargs)
+	return json_response({ "job": job_id, "url": f"/system/jobs/{job_id}" }, status=202)
+
 ###################################
 
 # Control Panel (unauthenticated views)
@@ -231,6 +248,13 @@ def mail_users_remove():
 	return remove_mail_user(request.form.get('email', ''), env)
 
 
+@app.route('/mail/users/bulk', methods=['POST'])
+@authorized_personnel_only
+def mail_users_bulk():
+	rows = get_bulk_rows()
+	if isinstance(rows, tuple): return rows # error
+	return bulk_update_mail_users(rows, env)
+
 @app.route('/mail/users/privileges')
 @authorized_personnel_only
 def mail_user_privs():
@@ -272,6 +296,24 @@ def mail_aliases_add():
 def mail_aliases_remove():
 	return remove_mail_alias(request.form.get('address', ''), env)
 
+@app.route('/mail/aliases/bulk', methods=['POST'])
+@authorized_personnel_only
+def mail_aliases_bulk():
+	rows = get_bulk_rows()
+	if isinstance(rows, tuple): return rows # error
+	return bulk_update_mail_aliases(rows, env)
+
+def get_bulk_rows():
+	# The body of a bulk request is either a JSON list of objects or CSV
+	# with a header line naming the columns.
+	if request.is_json:
+		rows = request.get_json(silent=True)
+		if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+			return ("The request body must be a JSON list of objects.", 400)
+		return rows
+	import csv, io
+	return list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+
 @app.route('/mail/domains')
 @authorized_personnel_only
 def mail_domains():
@@ -289,8 +331,11 @@ def dns_zones():
 @authorized_personnel_only
 def dns_update():
 	from dns_update import do_dns_update
+	force = request.form.get('force', '') == '1'
+	if is_job_request():
+		return submit_job("dns-update", do_dns_update, env, force=force)
 	try:
-		return do_dns_update(env, force=request.form.get('force', '') == '1')
+		return do_dns_update(env, force=force)
 	except Exception as e:
 		return (str(e), 500)
 
@@ -333,12 +378,11 @@ def dns_get_records(qname=None, rtype=None):
 	# To help with grouping by zone in qname sorting, label each record with which zone it is in.
 	# There's an inconsistency in how we handle zones in get_dns_zones and in sort_domains, so
 	# do this first before sorting the domains within the zones.
-	zones = utils.sort_domains([z[0] for z in get_dns_zones(env)], env)
+	zones = utils.DomainSuffixIndex(z[0] for z in get_dns_zones(env))
 	for r in records:
-		for z in zones:
-			if r["qname"] == z or r["qname"].endswith("." + z):
-				r["zone"] = z
-				break
+		zone = zones.find(r["qname"])
+		if zone is not None:
+			r["zone"] = zone
 
 	# Add sorting information. The 'created' order follows the order in the YAML file on disk,
 	# which tracs the order entries were added in the control panel since we append to the end.
@@ -476,9 +520,14 @@ def ssl_install_cert():
 @app.route('/ssl/provision', methods=['POST'])
 @authorized_personnel_only
 def ssl_provision_certs():
+	if is_job_request():
+		return submit_job("ssl-provision", provision_certificates_for_all_domains)
+	return json_response(provision_certificates_for_all_domains())
+
+def provision_certificates_for_all_domains():
 	from ssl_certificates import provision_certificates
 	requests = provision_certificates(env, limit_domains=None)
-	return json_response({ "requests": requests })
+	return { "requests": requests }
 
 # multi-factor auth
 
@@ -547,6 +596,8 @@ def web_get_domains():
 @authorized_personnel_only
 def web_update():
 	from web_update import do_web_update
+	if is_job_request():
+		return submit_job("web-update", do_web_update, env)
 	return do_web_update(env)
 
 # System
@@ -572,11 +623,23 @@ def system_latest_upstream_version():
 @app.route('/system/status', methods=["POST"])
 @authorized_personnel_only
 def system_status():
+	# Pass incremental=1 to reuse the results of the last checks for domains
+	# where nothing they depend on has changed, and force=1 to check every
+	# domain anyway.
+	incremental = request.values.get('incremental', '') == '1'
+	force = request.values.get('force', '') == '1'
+	if is_job_request():
+		return submit_job("system-status", run_status_checks, incremental=incremental, force=force)
+	return json_response(run_status_checks(incremental=incremental, force=force))
+
+def run_status_checks(incremental=False, force=False):
 	from status_checks import run_checks
 	class WebOutput:
 		def __init__(self):
 			self.items = []
 		def add_heading(self, heading):
+			# When run as a job, report what's been checked so far.
+			jobs.report_progress(self.items)
 			self.items.append({ "type": "heading", "text": heading, "extra": [] })
 		def print_ok(self, message):
 			self.items.append({ "type": "ok", "text": message, "extra": [] })
@@ -587,12 +650,24 @@ def system_status():
 		def print_line(self, message, monospace=False):
 			self.items[-1]["extra"].append({ "text": message, "monospace": monospace })
 	output = WebOutput()
-	# Create a temporary pool of processes for the status checks
-	with multiprocessing.pool.Pool(processes=5) as pool:
-		run_checks(False, env, output, pool)
-		pool.close()
-		pool.join()
-	return json_response(output.items)
+	run_checks(False, env, output, get_status_checks_pool(), incremental=incremental, force=force)
+	return output.items
+
+# The status checks run in a pool of worker threads that is created the
+# first time it's needed and kept for the life of the daemon, rather than
+# forking a pool of processes for each request. Threads also share the
+# certificates and configuration that run_checks loads once per run. The
+# number of workers can be set with STATUS_CHECKS_WORKERS in
+# /etc/mailinabox.conf.
+status_checks_pool = None
+status_checks_pool_lock = threading.Lock()
+
+def get_status_checks_pool():
+	global status_checks_pool
+	with status_checks_pool_lock:
+		if status_checks_pool is None:
+			status_checks_pool = multiprocessing.pool.ThreadPool(processes=int(env.get("STATUS_CHECKS_WORKERS", 5)))
+		return status_checks_pool
 
 @app.route('/system/updates')
 @authorized_personnel_only
@@ -605,11 +680,35 @@ def show_updates():
 @app.route('/system/update-packages', methods=["POST"])
 @authorized_personnel_only
 def do_updates():
+	if is_job_request():
+		return submit_job("update-packages", update_packages)
+	return update_packages()
+
+def update_packages():
+	jobs.report_progress("Updating the package list.")
 	utils.shell("check_call", ["/usr/bin/apt-get", "-qq", "update"])
+	jobs.report_progress("Installing package updates.")
 	return utils.shell("check_output", ["/usr/bin/apt-get", "-y", "upgrade"], env={
 		"DEBIAN_FRONTEND": "noninteractive"
 	})
 
+@app.route('/system/jobs/<job_id>', methods=["GET"])
+@authorized_personnel_only
+def get_job(job_id):
+	# Returns a job's status ("queued", "running", "finished" or "failed"), its
+	# progress so far, and its result or error. With wait=N, waits up to N
+	# seconds (at most 10) for the job to finish before responding. Each wait
+	# ties up one of the few gunicorn workers, so longer waits are cut short
+	# and the client polls again.
+	try:
+		wait = min(max(float(request.args.get('wait', '0')), 0), 10)
+	except ValueError:
+		return ("Invalid wait.", 400)
+	job = job_queue.wait(job_id, wait)
+	if job is None:
+		return ("That's not a job.", 404)
+	return json_response(job)
+
 
 @app.route('/system/reboot', methods=["GET"])
 @authorized_personnel_only
@@ -686,7 +785,7 @@ def munin_start():
 def check_request_cookie_for_admin_access():
 	session = auth_service.get_session(None, request.cookies.get("session", ""), "cookie", env)
 	if not session: return False
-	privs = get_mail_user_privileges(session["email"], env)
+	privs = auth_service.get_user_auth_state(session["email"], env)["privileges"]
 	if not isinstance(privs, list): return False
 	return "admin" in privs
 
@@ -785,5 +884,10 @@ if __name__ == '__main__':
 
 	#app.logger.info('API key: ' + auth_service.key)
 
+	# Read mailbox sizes in the background so the users page is quick to load
+	# the first time it's opened, even on boxes with many mailboxes. Under
+	# gunicorn, each worker does this once it has started (see gunicorn_conf.py).
+	start_warming_mailbox_usage_cache(env)
+
 	# Start the application server. Listens on 127.0.0.1 (IPv4 only).
 	app.run(port=10222)
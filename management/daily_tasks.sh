@@ -21,5 +21,6 @@ management/backup.py 2>&1 | management/email_administrator.py "Backup Status"
 # Provision any new certificates for new domains or domains with expiring certificates.
 management/ssl_certificates.py -q  2>&1 | management/email_administrator.py "TLS Certificate Provisioning Result"
 
-# Run status checks and email the administrator if anything changed.
-management/status_checks.py --show-changes  2>&1 | management/email_administrator.py "Status Checks Change Notice"
+# Run status checks and email the administrator if anything changed. Only
+# domains where something the checks depend on has changed are checked again.
+management/status_checks.py --show-changes --incremental  2>&1 | management/email_administrator.py "Status Checks Change Notice"
@@ -4,12 +4,12 @@
 # and mail aliases and restarts nsd.
 ########################################################################
 
-import sys, os, os.path, datetime, re, hashlib, base64
+import sys, os, os.path, datetime, re, hashlib, base64, json, threading, time
 import ipaddress
 import rtyaml
 import dns.resolver
 
-from utils import shell, load_env_vars_from_file, safe_domain_name, sort_domains, get_ssh_port
+from utils import shell, load_env_vars_from_file, safe_domain_name, sort_domains, get_ssh_port, DomainSuffixIndex, config_snapshot, memoized, forget_memoized, write_file_atomic, write_file_if_changed, file_lock, update_lock
 from ssl_certificates import get_ssl_certificates, check_certificate
 
 # From https://stackoverflow.com/questions/3026957/how-to-validate-a-domain-name-using-regex-php/16491074#16491074
@@ -24,45 +24,52 @@ def get_dns_domains(env):
 	# lead to infinite recursion here) and ensure PRIMARY_HOSTNAME is in the list.
 	from mailconfig import get_mail_domains
 	from web_update import get_web_domains
-	domains = set()
-	domains |= set(get_mail_domains(env))
-	domains |= set(get_web_domains(env, include_www_redirects=False))
-	domains.add(env['PRIMARY_HOSTNAME'])
-	return domains
+	def query():
+		domains = set()
+		domains |= set(get_mail_domains(env))
+		domains |= set(get_web_domains(env, include_www_redirects=False))
+		domains.add(env['PRIMARY_HOSTNAME'])
+		return domains
+	return set(memoized(env, "dns_domains", query))
 
 def get_dns_zones(env):
+	return [list(zone) for zone in memoized(env, "dns_zones", lambda: query_dns_zones(env))]
+
+def query_dns_zones(env):
 	# What domains should we create DNS zones for? Never create a zone for
 	# a domain & a subdomain of that domain.
 	domains = get_dns_domains(env)
 
 	# Exclude domains that are subdomains of other domains we know. Proceed
 	# by looking at shorter domains first.
-	zone_domains = set()
+	zone_domains = DomainSuffixIndex()
 	for domain in sorted(domains, key=len):
-		for d in zone_domains:
-			if domain.endswith("." + d):
-				# We found a parent domain already in the list.
-				break
-		else:
-			# 'break' did not occur: there is no parent domain.
+		if zone_domains.find(domain, include_self=False) is None:
+			# There is no parent domain.
 			zone_domains.add(domain)
 
-	# Make a nice and safe filename for each domain.
-	zonefiles = [[domain, safe_domain_name(domain) + ".txt"] for domain in zone_domains]
-
 	# Sort the list so that the order is nice and so that nsd.conf has a
 	# stable order so we don't rewrite the file & restart the service
-	# meaninglessly.
-	zone_order = sort_domains([ zone[0] for zone in zonefiles ], env)
-	zonefiles.sort(key = lambda zone : zone_order.index(zone[0]) )
-
-	return zonefiles
+	# meaninglessly. Then make a nice and safe filename for each domain.
+	zone_order = sort_domains([ domain for domain in domains if domain in zone_domains ], env)
+	return [[domain, safe_domain_name(domain) + ".txt"] for domain in zone_order]
 
 def do_dns_update(env, force=False):
+	return do_dns_update_ex(env, force=force)[0]
+
+@update_lock()
+def do_dns_update_ex(env, force=False):
+	# Update the DNS configuration and return its output along with the list
+	# of (domain, error message) for zones that could not be signed.
+
+	# Look up users, aliases, domains, etc. once for the whole update.
+	env = config_snapshot(env)
+
 	# Write zone files.
 	os.makedirs('/etc/nsd/zones', exist_ok=True)
 	zonefiles = []
 	updated_domains = []
+	zones_to_sign = []
 	for (domain, zonefile, records) in build_zones(env):
 		# The final set of files will be signed.
 		zonefiles.append((domain, zonefile + ".signed"))
@@ -85,7 +92,12 @@ def do_dns_update(env, force=False):
 		# write_nsd_zone is smart enough to check if a zone's signature
 		# is nearing expiration and if so it'll bump the serial number
 		# and return True so we get a chance to re-sign it.
-		sign_zone(domain, zonefile, env)
+		zones_to_sign.append((domain, zonefile))
+
+	# Sign the zones that changed. The order doesn't matter, so sign several
+	# at once.
+	signing_errors = sign_zones(zones_to_sign, env)
+	prune_ds_cache({ domain for domain, _zonefile in zonefiles })
 
 	# Write the main nsd.conf file.
 	if write_nsd_conf(zonefiles, list(get_custom_dns_config(env)), env):
@@ -110,8 +122,13 @@ def do_dns_update(env, force=False):
 	# Write the OpenDKIM configuration tables for all of the mail domains.
 	from mailconfig import get_mail_domains
 	if write_opendkim_tables(get_mail_domains(env), env):
-		# Settings changed. Kick opendkim.
-		shell('check_call', ["/usr/sbin/service", "opendkim", "restart"])
+		# Settings changed. Have opendkim reload its tables, which it does
+		# without dropping the connections it's handling (SIGUSR1). If that
+		# fails, e.g. because it isn't running, restart it.
+		try:
+			shell('check_call', ["/usr/sbin/service", "opendkim", "reload"])
+		except:
+			shell('check_call', ["/usr/sbin/service", "opendkim", "restart"])
 		if len(updated_domains) == 0:
 			# If this is the only thing that changed?
 			updated_domains.append("OpenDKIM configuration")
@@ -120,10 +137,11 @@ def do_dns_update(env, force=False):
 	# (ignore errors with trap=True)
 	shell('check_call', ["/usr/sbin/rndc", "flush"], trap=True)
 
+	ret = "".join(f"DNSSEC signing failed for {domain}: {error}\n" for domain, error in signing_errors)
 	if len(updated_domains) == 0:
 		# if nothing was updated (except maybe OpenDKIM's files), don't show any output
-		return ""
-	return "updated DNS: " + ",".join(updated_domains) + "\n"
+		return (ret, signing_errors)
+	return ("updated DNS: " + ",".join(updated_domains) + "\n" + ret, signing_errors)
 
 ########################################################################
 
@@ -164,7 +182,7 @@ def build_zones(env):
 	domains[env["PRIMARY_HOSTNAME"]]["certificate-is-valid"] = is_domain_cert_signed_and_valid(env["PRIMARY_HOSTNAME"], env)
 
 	# Load custom records to add to zones.
-	additional_records = list(get_custom_dns_config(env))
+	additional_records = get_custom_dns_config(env)
 
 	# Build DNS records for each zone.
 	for domain, zonefile in zonefiles:
@@ -172,8 +190,36 @@ def build_zones(env):
 		records = build_zone(domain, domains, additional_records, env)
 		yield (domain, zonefile, records)
 
+class ZoneRecords(list):
+	# A list of (qname, rtype, value, explanation) records that also indexes
+	# the values by qname and rtype, so that checking whether the zone has a
+	# record doesn't scan all of the records. Only append and extend keep the
+	# index up to date, so don't modify the list in any other way except to
+	# reorder it.
+
+	def __init__(self, records=()):
+		super().__init__()
+		self.index = { }
+		self.extend(records)
+
+	def append(self, record):
+		super().append(record)
+		self.index.setdefault((record[0], record[1]), []).append(record[2])
+
+	def extend(self, records):
+		for record in records:
+			self.append(record)
+
+	def has(self, qname, rtype, prefix=None):
+		# Is there a record for qname and rtype, and if prefix is given, one
+		# whose value starts with prefix?
+		values = self.index.get((qname, rtype), [])
+		if prefix is None:
+			return len(values) > 0
+		return any(value.startswith(prefix) for value in values)
+
 def build_zone(domain, domain_properties, additional_records, env, is_zone=True):
-	records = []
+	records = ZoneRecords()
 
 	# For top-level zones, define the authoritative name servers.
 	#
@@ -224,9 +270,9 @@ def build_zone(domain, domain_properties, additional_records, env, is_zone=True)
 					child_qname += "." + subdomain_qname
 				records.append((child_qname, child_rtype, child_value, child_explanation))
 
-	has_rec_base = list(records) # clone current state
+	has_rec_base = ZoneRecords(records) # clone current state
 	def has_rec(qname, rtype, prefix=None):
-		return any(rec[0] == qname and rec[1] == rtype and (prefix is None or rec[2].startswith(prefix)) for rec in has_rec_base)
+		return has_rec_base.has(qname, rtype, prefix)
 
 	# The user may set other records that don't conflict with our settings.
 	# Don't put any TXT records above this line, or it'll prevent any custom TXT records.
@@ -251,7 +297,7 @@ def build_zone(domain, domain_properties, additional_records, env, is_zone=True)
 	# we should not cause the default AAAA record to be skipped because it thinks a custom A record
 	# was set. So set has_rec_base to a clone of the current set of DNS settings, and don't update
 	# during this process.
-	has_rec_base = list(records)
+	has_rec_base = ZoneRecords(records)
 	a_expl = f"Required. May have a different value. Sets the IP address that {domain} resolves to for web hosting and other services besides mail. The A record must be present but its value does not affect mail delivery."
 	if domain_properties[domain]["auto"]:
 		if domain.startswith(("ns1.", "ns2.")): a_expl = False # omit from 'External DNS' page since this only applies if box is its own DNS server
@@ -375,10 +421,35 @@ def build_zone(domain, domain_properties, additional_records, env, is_zone=True)
 
 	return records
 
+# The records and certificate checks below are the same for every zone and
+# only change when the SSH host keys or the certificates change. They're kept
+# for as long as the files they were made from have the same inode,
+# modification time and size. Certificate checks are also redone after
+# CERTIFICATE_CHECK_CACHE_SECONDS because certificates expire.
+CERTIFICATE_CHECK_CACHE_SECONDS = 60*60
+certificate_check_cache = { }
+tlsa_record_cache = { }
+sshfp_records_cache = { }
+
+def get_files_stat(fns):
+	ret = []
+	for fn in fns:
+		try:
+			st = os.stat(fn)
+			ret.append((fn, os.path.realpath(fn), st.st_ino, st.st_mtime_ns, st.st_size))
+		except OSError:
+			ret.append((fn,))
+	return tuple(ret)
+
 def is_domain_cert_signed_and_valid(domain, env):
 	cert = get_ssl_certificates(env).get(domain)
 	if not cert: return False # no certificate provisioned
+	stat = get_files_stat([cert['certificate'], cert['private-key']])
+	cached = certificate_check_cache.get(domain)
+	if cached is not None and cached[0] == stat and time.time() - cached[1] < CERTIFICATE_CHECK_CACHE_SECONDS:
+		return cached[2]
 	cert_status = check_certificate(domain, cert['certificate'], cert['private-key'])
+	certificate_check_cache[domain] = (stat, time.time(), cert_status[0] == 'OK')
 	return cert_status[0] == 'OK'
 
 ########################################################################
@@ -407,6 +478,10 @@ def build_tlsa_record(env):
 	from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
 
 	fn = os.path.join(env["STORAGE_ROOT"], "ssl", "ssl_certificate.pem")
+	key = get_files_stat([fn])
+	record = tlsa_record_cache.get(key)
+	if record is not None:
+		return record
 	cert = load_pem(load_cert_chain(fn)[0])
 
 	subject_public_key = cert.public_key().public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
@@ -418,9 +493,34 @@ def build_tlsa_record(env):
 	# 3: Match the (leaf) certificate. (No CA, no trust path needed.)
 	# 1: Match its subject public key.
 	# 1: Use SHA256.
-	return "3 1 1 " + pk_hash
+	# Only keep the current certificate's record. Another thread may replace
+	# it at any time, so return the record made here rather than reading it back.
+	record = "3 1 1 " + pk_hash
+	tlsa_record_cache.clear()
+	tlsa_record_cache[key] = record
+	return record
 
 def build_sshfp_records():
+	# Running ssh-keyscan (and sshd -T to get the port) is slow, so the
+	# records are kept until the host keys or the SSH configuration change.
+	# Only a scan that found keys is kept. If sshd wasn't up yet or the scan
+	# failed, we try again next time rather than publishing no records until
+	# the keys change.
+	import glob
+	key = get_files_stat(sorted(glob.glob("/etc/ssh/ssh_host_*_key.pub"))
+		+ ["/etc/ssh/sshd_config"] + sorted(glob.glob("/etc/ssh/sshd_config.d/*")))
+	# The key and the records are stored together as one tuple so that another
+	# thread replacing them can't leave a mismatched or missing pair.
+	cached = sshfp_records_cache.get("records")
+	if cached is not None and cached[0] == key:
+		return list(cached[1])
+	sshfp_records_cache.pop("records", None)
+	records = list(scan_sshfp_records())
+	if records:
+		sshfp_records_cache["records"] = (key, records)
+	return list(records)
+
+def scan_sshfp_records():
 	# The SSHFP record is a way for us to embed this server's SSH public
 	# key fingerprint into the DNS so that remote hosts have an out-of-band
 	# method to confirm the fingerprint. See RFC 4255 and RFC 6594. This
@@ -486,7 +586,7 @@ def write_nsd_zone(domain, zonefile, records, env, force):
 	# the keys change we force a re-generation of the zone which triggers
 	# re-signing it.
 
-	zone = """
+	zone = ["""
 $ORIGIN {domain}.
 $TTL 86400          ; default time to live
 
@@ -497,31 +597,33 @@ $TTL 86400          ; default time to live
            1209600  ; Expire (when refresh fails, how long secondary nameserver will keep records around anyway)
            86400    ; Negative TTL (how long negative responses are cached)
            )
-"""
-
-	# Replace replacement strings.
-	zone = zone.format(domain=domain, primary_domain=env["PRIMARY_HOSTNAME"])
+""".format(domain=domain, primary_domain=env["PRIMARY_HOSTNAME"])]
 
 	# Add records.
 	for subdomain, querytype, value, _explanation in records:
-		if subdomain:
-			zone += subdomain
-		zone += "\tIN\t" + querytype + "\t"
 		if querytype == "TXT":
 			# Divide into 255-byte max substrings.
-			v2 = ""
+			v2 = []
 			while len(value) > 0:
 				s = value[0:255]
 				value = value[255:]
 				s = s.replace('\\', '\\\\') # escape backslashes
 				s = s.replace('"', '\\"') # escape quotes
 				s = '"' + s + '"' # wrap in quotes
-				v2 += s + " "
-			value = v2
-		zone += value + "\n"
+				v2.append(s + " ")
+			value = "".join(v2)
+		zone.append((subdomain or "") + "\tIN\t" + querytype + "\t" + value + "\n")
 
 	# Append a stable hash of DNSSEC signing keys in a comment.
-	zone += f"\n; DNSSEC signing keys hash: {hash_dnssec_keys(domain, env)}\n"
+	zone.append(f"\n; DNSSEC signing keys hash: {hash_dnssec_keys(domain, env)}\n")
+	zone = "".join(zone)
+
+	# The zone's state from the last time it was written, which saves reading
+	# the zone file and its signed version to see if it has changed and if its
+	# signatures are expiring. If there's no state or the zone file was changed
+	# outside of this function, look at the files instead.
+	zone_hash = hashlib.sha256(zone.encode("utf8")).hexdigest()
+	state = read_zone_state(zonefile)
 
 	# DNSSEC requires re-signing a zone periodically. That requires
 	# bumping the serial number even if no other records have changed.
@@ -529,7 +631,11 @@ $TTL 86400          ; default time to live
 	# if a re-signing is necessary so we can prematurely bump the
 	# serial number.
 	force_bump = False
-	if not os.path.exists(zonefile + ".signed"):
+	expiration_time = None
+	if state is not None and state.get("signing_failed"):
+		# The last attempt to sign the zone failed, so try again.
+		force_bump = True
+	elif not os.path.exists(zonefile + ".signed"):
 		# No signed file yet. Shouldn't normally happen unless a box
 		# is going from not using DNSSEC to using DNSSEC.
 		force_bump = True
@@ -537,23 +643,24 @@ $TTL 86400          ; default time to live
 		# We've signed the domain. Check if we are close to the expiration
 		# time of the signature. If so, we'll force a bump of the serial
 		# number so we can re-sign it.
-		with open(zonefile + ".signed", encoding="utf-8") as f:
-			signed_zone = f.read()
-		expiration_times = re.findall(r"\sRRSIG\s+SOA\s+\d+\s+\d+\s\d+\s+(\d{14})", signed_zone)
-		if len(expiration_times) == 0:
-			# weird
-			force_bump = True
+		if state is not None:
+			expiration_time = state["expires"] and datetime.datetime.fromtimestamp(state["expires"], datetime.timezone.utc)
 		else:
-			# All of the times should be the same, but if not choose the soonest.
-			expiration_time = min(expiration_times)
-			expiration_time = datetime.datetime.strptime(expiration_time, "%Y%m%d%H%M%S")
-			if expiration_time - datetime.datetime.now() < datetime.timedelta(days=3):
-				# We're within three days of the expiration, so bump serial & resign.
-				force_bump = True
+			expiration_time = get_signature_expiration(zonefile + ".signed")
+		if expiration_time is None:
+			# weird, or the zone was not signed successfully
+			force_bump = True
+		elif expiration_time - datetime.datetime.now(datetime.timezone.utc) < datetime.timedelta(days=3):
+			# We're within three days of the expiration, so bump serial & resign.
+			force_bump = True
 
 	# Set the serial number.
 	serial = datetime.datetime.now().strftime("%Y%m%d00")
-	if os.path.exists(zonefile):
+	existing_serial = None
+	if state is not None:
+		existing_serial = state["serial"]
+		existing_zone_changed = state["hash"] != zone_hash
+	elif os.path.exists(zonefile):
 		# If the zone already exists, is different, and has a later serial number,
 		# increment the number.
 		with open(zonefile, encoding="utf-8") as f:
@@ -564,27 +671,90 @@ $TTL 86400          ; default time to live
 				# purposes of seeing if anything *else* in the zone has changed.
 				existing_serial = m.group(1)
 				existing_zone = existing_zone.replace(m.group(0), "__SERIAL__     ; serial number")
-
-				# If the existing zone is the same as the new zone (modulo the serial number),
-				# there is no need to update the file. Unless we're forcing a bump.
-				if zone == existing_zone and not force_bump and not force:
-					return False
-
-				# If the existing serial is not less than a serial number
-				# based on the current date plus 00, increment it. Otherwise,
-				# the serial number is less than our desired new serial number
-				# so we'll use the desired new number.
-				if existing_serial >= serial:
-					serial = str(int(existing_serial) + 1)
+				existing_zone_changed = zone != existing_zone
+
+	if existing_serial is not None:
+		# If the existing zone is the same as the new zone (modulo the serial number),
+		# there is no need to update the file. Unless we're forcing a bump.
+		if not existing_zone_changed and not force_bump and not force:
+			if state is None:
+				# Record the state found by reading the files so that next
+				# time they don't have to be read again.
+				write_zone_state(zonefile, { "hash": zone_hash, "serial": existing_serial, "expires": expiration_time.timestamp() })
+			return False
+
+		# If the existing serial is not less than a serial number
+		# based on the current date plus 00, increment it. Otherwise,
+		# the serial number is less than our desired new serial number
+		# so we'll use the desired new number.
+		if existing_serial >= serial:
+			serial = str(int(existing_serial) + 1)
 
 	zone = zone.replace("__SERIAL__", serial)
 
-	# Write the zone file.
-	with open(zonefile, "w", encoding="utf-8") as f:
-		f.write(zone)
+	# Write the zone file. It hasn't been signed yet, so there's no signature
+	# expiration in its state until sign_zone records it.
+	write_file_atomic(zonefile, zone)
+	write_zone_state(zonefile, { "hash": zone_hash, "serial": serial, "expires": None })
 
 	return True # file is updated
 
+def get_signature_expiration(signed_zonefile):
+	# Returns the expiration time of the SOA's signature in a signed zone file,
+	# or None if the file has no SOA signature.
+	try:
+		with open(signed_zonefile, encoding="utf-8") as f:
+			signed_zone = f.read()
+	except FileNotFoundError:
+		return None
+	expiration_times = re.findall(r"\sRRSIG\s+SOA\s+\d+\s+\d+\s\d+\s+(\d{14})", signed_zone)
+	if len(expiration_times) == 0:
+		return None
+	# All of the times should be the same, but if not choose the soonest.
+	expiration_time = min(expiration_times)
+	return datetime.datetime.strptime(expiration_time, "%Y%m%d%H%M%S").replace(tzinfo=datetime.timezone.utc)
+
+def read_zone_state(zonefile):
+	# Returns the state that was recorded for the zone file the last time it
+	# was written: a dict with the hash of the zone (before the serial number
+	# is filled in), its serial number, when the signature of its SOA record
+	# expires (as a Unix timestamp, or None if it hasn't been signed), and
+	# signing_failed if the last attempt to sign it failed.
+	# Returns None if there's no state or if the zone file has been modified
+	# since then.
+	try:
+		with open(zonefile + ".state", encoding="utf-8") as f:
+			state = json.load(f)
+		st = os.stat(zonefile)
+	except (OSError, ValueError):
+		return None
+	if state.get("zonefile") != [st.st_mtime_ns, st.st_size]:
+		return None
+	return state
+
+def write_zone_state(zonefile, state):
+	# Record the zone's state along with the size and modification time of the
+	# zone file it applies to.
+	st = os.stat(zonefile)
+	state = dict(state, zonefile=[st.st_mtime_ns, st.st_size])
+	write_file_atomic(zonefile + ".state", json.dumps(state))
+
+def set_zone_signature_expiration(zonefile, expiration_time):
+	# Record when the signatures of a zone that was just signed expire.
+	state = read_zone_state(zonefile)
+	if state is not None:
+		state["expires"] = expiration_time.timestamp() if expiration_time is not None else None
+		write_zone_state(zonefile, state)
+
+def set_zone_signing_failed(zonefile):
+	# Record that signing the zone failed, so that write_nsd_zone has it signed
+	# again next time even if nothing in the zone changed.
+	state = read_zone_state(zonefile)
+	if state is not None:
+		state["expires"] = None
+		state["signing_failed"] = True
+		write_zone_state(zonefile, state)
+
 def get_dns_zonefile(zone, env):
 	for domain, fn in get_dns_zones(env):
 		if zone == domain:
@@ -602,47 +772,64 @@ def get_dns_zonefile(zone, env):
 def write_nsd_conf(zonefiles, additional_records, env):
 	# Write the list of zones to a configuration file.
 	nsd_conf_file = "/etc/nsd/nsd.conf.d/zones.conf"
-	nsdconf = ""
+	nsdconf = []
+
+	# The secondary nameservers are the same for every zone.
+	secondary_dns_xfr = get_secondary_dns(additional_records, mode="xfr")
 
 	# Append the zones.
 	for domain, zonefile in zonefiles:
-		nsdconf += f"""
+		nsdconf.append(f"""
 zone:
 	name: {domain}
 	zonefile: {zonefile}
-"""
+""")
 
 		# If custom secondary nameservers have been set, allow zone transfers
 		# and, if not a subnet, notifies to them.
-		for ipaddr in get_secondary_dns(additional_records, mode="xfr"):
+		for ipaddr in secondary_dns_xfr:
 			if "/" not in ipaddr:
-				nsdconf += f"\n\tnotify: {ipaddr} NOKEY"
-			nsdconf += f"\n\tprovide-xfr: {ipaddr} NOKEY\n"
-
-	# Check if the file is changing. If it isn't changing,
-	# return False to flag that no change was made.
-	if os.path.exists(nsd_conf_file):
-		with open(nsd_conf_file, encoding="utf-8") as f:
-			if f.read() == nsdconf:
-				return False
+				nsdconf.append(f"\n\tnotify: {ipaddr} NOKEY")
+			nsdconf.append(f"\n\tprovide-xfr: {ipaddr} NOKEY\n")
 
-	# Write out new contents and return True to signal that
-	# configuration changed.
-	with open(nsd_conf_file, "w", encoding="utf-8") as f:
-		f.write(nsdconf)
-	return True
+	# Write out new contents if the file is changing and return True to
+	# signal that configuration changed, or False if no change was made.
+	return write_file_if_changed(nsd_conf_file, "".join(nsdconf))
 
 ########################################################################
 
+# The DNSSEC key .conf and .private files are the same for every zone, so
+# they are kept after they are read, along with their inode, modification
+# time and size, and only read again if they change.
+dnssec_file_cache = { }
+
+def read_dnssec_file(fn, parse):
+	st = os.stat(fn)
+	stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+	cached = dnssec_file_cache.get(fn)
+	if cached is not None and cached[0] == stat:
+		return cached[1]
+	value = parse(fn)
+	dnssec_file_cache[fn] = (stat, value)
+	return value
+
+def read_text_file(fn):
+	with open(fn, encoding="utf-8") as f:
+		return f.read()
+
+def get_dnssec_key_confs(env):
+	# Load the files holding the KSK and ZSK key filenames, one for each key
+	# that we generated (one per algorithm). Within a configuration snapshot
+	# the directory is only listed once.
+	def load():
+		d = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec')
+		return [read_dnssec_file(os.path.join(d, f), load_env_vars_from_file)
+			for f in os.listdir(d) if f.endswith(".conf")]
+	return memoized(env, "dnssec_key_confs", load)
+
 def find_dnssec_signing_keys(domain, env):
 	# For key that we generated (one per algorithm)...
-	d = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec')
-	keyconfs = [f for f in os.listdir(d) if f.endswith(".conf")]
-	for keyconf in keyconfs:
-		# Load the file holding the KSK and ZSK key filenames.
-		keyconf_fn = os.path.join(d, keyconf)
-		keyinfo = load_env_vars_from_file(keyconf_fn)
-
+	for keyinfo in get_dnssec_key_confs(env):
 		# Skip this key if the conf file has a setting named DOMAINS,
 		# holding a comma-separated list of domain names, and if this
 		# domain is not in the list. This allows easily disabling a
@@ -658,58 +845,125 @@ def find_dnssec_signing_keys(domain, env):
 
 def hash_dnssec_keys(domain, env):
 	# Create a stable (by sorting the items) hash of all of the private keys
-	# that will be used to sign this domain.
-	keydata = []
-	for keytype, keyfn in sorted(find_dnssec_signing_keys(domain, env)):
-		oldkeyfn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec', keyfn + ".private")
-		keydata.extend((keytype, keyfn))
-		with open(oldkeyfn, encoding="utf-8") as fr:
-			keydata.append( fr.read() )
-	keydata = "".join(keydata).encode("utf8")
-	return hashlib.sha1(keydata).hexdigest()
+	# that will be used to sign this domain. Usually every zone is signed with
+	# the same keys, so within a configuration snapshot the hash is only
+	# computed once for each set of keys.
+	keys = tuple(sorted(find_dnssec_signing_keys(domain, env)))
+	hashes = memoized(env, "dnssec_key_hashes", dict)
+	if keys not in hashes:
+		keydata = []
+		for keytype, keyfn in keys:
+			oldkeyfn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec', keyfn + ".private")
+			keydata.extend((keytype, keyfn))
+			keydata.append( read_dnssec_file(oldkeyfn, read_text_file) )
+		keydata = "".join(keydata).encode("utf8")
+		hashes[keys] = hashlib.sha1(keydata).hexdigest()
+	return hashes[keys]
+
+def sign_zones(zones, env):
+	# Sign each of the (domain, zonefile) zones, several at a time. Signing is
+	# mostly spent waiting on ldns-signzone, so threads are enough to keep one
+	# signing process going per CPU. Returns a list of (domain, error message)
+	# for the zones that could not be signed.
+	from concurrent.futures import ThreadPoolExecutor
+
+	def sign(zone):
+		domain, zonefile = zone
+		try:
+			sign_zone(domain, zonefile, env)
+		except Exception as e:
+			# The zone file already has the new serial number, so the next update
+			# would see no changes and not try to sign it again. Record the
+			# failure in the zone's state so that it does.
+			set_zone_signing_failed("/etc/nsd/zones/" + zonefile)
+			return (domain, str(e) or e.__class__.__name__)
+		return None
+
+	with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+		return [error for error in pool.map(sign, zones) if error is not None]
 
 def sign_zone(domain, zonefile, env):
 	# Sign the zone with all of the keys that were generated during
 	# setup so that the user can choose which to use in their DS record at
 	# their registrar, and also to support migration to newer algorithms.
-
+	#
+	# Zones are signed by ldns-signzone unless DNSSEC_SIGNING_ENGINE=dnspython
+	# is set, in which case they are signed in-process by dnssec_signer.
+	if get_dnssec_signing_engine(env) == "dnspython":
+		expiration_time = sign_zone_with_dnspython(domain, zonefile, env)
+	else:
+		expiration_time = sign_zone_with_ldns(domain, zonefile, env)
+
+	# Remember when the signatures expire so that write_nsd_zone doesn't have to
+	# read the signed zone file to know when to re-sign it.
+	set_zone_signature_expiration("/etc/nsd/zones/" + zonefile, expiration_time)
+
+def get_dnssec_signing_engine(env):
+	# dnspython can only sign if a recent enough version of cryptography is
+	# installed. Otherwise dns.dnssec.sign raises on every call, so use
+	# ldns-signzone instead rather than fail to sign every zone.
+	if env.get("DNSSEC_SIGNING_ENGINE") != "dnspython":
+		return "ldns"
+	with dnspython_can_sign_lock:
+		if "can_sign" not in dnspython_can_sign:
+			try:
+				import dns._features
+				can_sign = dns._features.have("dnssec")
+			except ImportError:
+				# dnspython before 2.4 doesn't have dns._features.
+				import dns.dnssec
+				can_sign = getattr(dns.dnssec, "_have_pyca", False)
+			if not can_sign:
+				print("DNSSEC_SIGNING_ENGINE=dnspython is set, but dnspython can't sign zones with the installed"
+					" version of the cryptography package. Signing zones with ldns-signzone instead.", file=sys.stderr)
+			dnspython_can_sign["can_sign"] = can_sign
+	return "dnspython" if dnspython_can_sign["can_sign"] else "ldns"
+
+dnspython_can_sign = { }
+dnspython_can_sign_lock = threading.Lock()
+
+def sign_zone_with_ldns(domain, zonefile, env):
 	# In order to use the key files generated at setup which are for
 	# the domain _domain_, we have to re-write the files and place
 	# the actual domain name in it, so that ldns-signzone works.
 	#
-	# Patch each key, storing the patched version in /tmp for now.
-	# Each key has a .key and .private file. Collect a list of filenames
-	# for all of the keys (and separately just the key-signing keys).
+	# Patch each key, storing the patched version in a temporary directory
+	# that only we (root) can read. Each key has a .key and .private file.
+	# Collect a list of filenames for all of the keys (and separately just
+	# the key-signing keys).
+	import tempfile, shutil
+	tmpdir = tempfile.mkdtemp(prefix="mailinabox-dnssec-")
+	try:
+		return sign_zone_with_keys_in(tmpdir, domain, zonefile, env)
+	finally:
+		# Remove the temporary patched key files.
+		shutil.rmtree(tmpdir)
+
+def sign_zone_with_keys_in(tmpdir, domain, zonefile, env):
 	all_keys = []
 	ksk_keys = []
 	for keytype, keyfn in find_dnssec_signing_keys(domain, env):
-		newkeyfn = '/tmp/' + keyfn.replace("_domain_", domain)
+		newkeyfn = os.path.join(tmpdir, keyfn.replace("_domain_", domain))
 
 		for ext in (".private", ".key"):
-			# Copy the .key and .private files to /tmp to patch them up.
-			#
-			# Use os.umask and open().write() to securely create a copy that only
-			# we (root) can read.
+			# Copy the .key and .private files to the temporary directory to patch them up.
 			oldkeyfn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec', keyfn + ext)
 			with open(oldkeyfn, encoding="utf-8") as fr:
 				keydata = fr.read()
 			keydata = keydata.replace("_domain_", domain)
-			prev_umask = os.umask(0o77) # ensure written file is not world-readable
-			try:
-				with open(newkeyfn + ext, "w", encoding="utf-8") as fw:
-					fw.write(keydata)
-			finally:
-				os.umask(prev_umask) # other files we write should be world-readable
+			with open(newkeyfn + ext, "w", encoding="utf-8") as fw:
+				fw.write(keydata)
 
 		# Put the patched key filename base (without extension) into the list of keys we'll sign with.
 		all_keys.append(newkeyfn)
-		if keytype == "KSK": ksk_keys.append(newkeyfn)
+		if keytype == "KSK": ksk_keys.append((newkeyfn, keydata))
 
-	# Do the signing.
-	expiry_date = (datetime.datetime.now() + datetime.timedelta(days=30)).strftime("%Y%m%d")
+	# Do the signing. The signatures expire at a time given here, so it's
+	# returned rather than read back from the signed zone file.
+	expiration_time = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=30)).replace(microsecond=0)
 	shell('check_call', ["/usr/bin/ldns-signzone",
 		# expire the zone after 30 days
-		"-e", expiry_date,
+		"-e", expiration_time.strftime("%Y%m%d%H%M%S"),
 
 		# use NSEC3
 		"-n",
@@ -721,6 +975,39 @@ def sign_zone(domain, zonefile, env):
 	]
 	)
 
+	write_ds_records(domain, zonefile, ksk_keys, lambda key: [
+		shell('check_output', ["/usr/bin/ldns-key2ds",
+			"-n", # output to stdout
+			"-" + digest_type, # 1=SHA1, 2=SHA256, 4=SHA384
+			key + ".key"
+		])
+		for digest_type in ('1', '2', '4')
+	])
+
+	return expiration_time
+
+def sign_zone_with_dnspython(domain, zonefile, env):
+	# dnssec_signer reads the key files generated at setup directly, since
+	# the domain name in them isn't needed to sign.
+	import dnssec_signer
+	keys = []
+	ksk_keys = []
+	for keytype, keyfn in find_dnssec_signing_keys(domain, env):
+		keyfn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec', keyfn)
+		keys.append((keytype, keyfn))
+		if keytype == "KSK":
+			# Patch the .key file in memory the way it is for ldns-signzone so
+			# that cached DS records are shared between the two ways of signing.
+			with open(keyfn + ".key", encoding="utf-8") as f:
+				ksk_keys.append((keyfn, f.read().replace("_domain_", domain)))
+
+	expiration_time = dnssec_signer.sign_zone(domain, "/etc/nsd/zones/" + zonefile, keys)
+
+	write_ds_records(domain, zonefile, ksk_keys, lambda key: dnssec_signer.make_ds_records(domain, key))
+
+	return expiration_time
+
+def write_ds_records(domain, zonefile, ksk_keys, make_ds_records):
 	# Create a DS record based on the patched-up key files. The DS record is specific to the
 	# zone being signed, so we can't use the .ds files generated when we created the keys.
 	# The DS record points to the KSK only. Write this next to the zone file so we can
@@ -730,20 +1017,84 @@ def sign_zone(domain, zonefile, env):
 	# be used, so we'll pre-generate all for each key. One DS record per line. Only one
 	# needs to actually be deployed at the registrar. We'll select the preferred one
 	# in the status checks.
-	with open("/etc/nsd/zones/" + zonefile + ".ds", "w", encoding="utf-8") as f:
-		for key in ksk_keys:
-			for digest_type in ('1', '2', '4'):
-				rr_ds = shell('check_output', ["/usr/bin/ldns-key2ds",
-					"-n", # output to stdout
-					"-" + digest_type, # 1=SHA1, 2=SHA256, 4=SHA384
-					key + ".key"
-				])
-				f.write(rr_ds)
-
-	# Remove the temporary patched key files.
-	for fn in all_keys:
-		os.unlink(fn + ".private")
-		os.unlink(fn + ".key")
+	#
+	# ksk_keys is a list of (key, patched .key file contents), and make_ds_records
+	# returns the DS record lines for a key.
+	#
+	# The DS records only depend on the domain name and the KSK, so they're cached
+	# by the hash of the patched KSK .key file (which has the domain name in it) and
+	# are only generated when a domain is first signed with a key.
+	cached_ds_records = get_cached_ds_records(domain)
+	ds_records = { }
+	for key, keydata in ksk_keys:
+		key_hash = hashlib.sha1(keydata.encode("utf8")).hexdigest()
+		if key_hash in cached_ds_records:
+			ds_records[key_hash] = cached_ds_records[key_hash]
+			continue
+		ds_records[key_hash] = {
+			"ds": make_ds_records(key),
+			# Some registrars want the public key, so keep it with the DS records.
+			"pubkey": keydata.split("\t")[3].split(" ")[3].strip(),
+		}
+	set_cached_ds_records(domain, ds_records)
+
+	write_file_if_changed("/etc/nsd/zones/" + zonefile + ".ds",
+		"".join(line for entry in ds_records.values() for line in entry["ds"]))
+
+DNSSEC_DS_CACHE_FILE = "/var/lib/mailinabox/dnssec-ds-cache.json"
+
+# Changes to the cache are read-modify-write, so they are made holding this
+# lock, which other processes (like the daemon's other workers) respect too.
+DNSSEC_DS_CACHE_LOCK_FILE = DNSSEC_DS_CACHE_FILE + ".lock"
+
+ds_cache_lock = threading.Lock()
+ds_cache = { "stat": None, "domains": { } }
+
+def load_ds_cache():
+	# Returns the DS record cache, which maps domains to KSK hashes to
+	# { "ds": [DS record lines], "pubkey": the KSK's public key }. The file
+	# is only re-read when it changes. Call with ds_cache_lock held.
+	try:
+		st = os.stat(DNSSEC_DS_CACHE_FILE)
+	except FileNotFoundError:
+		return { }
+	stat = (st.st_mtime_ns, st.st_size)
+	if ds_cache["stat"] != stat:
+		try:
+			with open(DNSSEC_DS_CACHE_FILE, encoding="utf-8") as f:
+				ds_cache["domains"] = json.load(f)
+		except (OSError, ValueError):
+			ds_cache["domains"] = { }
+		ds_cache["stat"] = stat
+	return ds_cache["domains"]
+
+def save_ds_cache(domains):
+	# Call with ds_cache_lock held.
+	write_file_atomic(DNSSEC_DS_CACHE_FILE, json.dumps(domains, indent=1, sort_keys=True))
+	ds_cache["stat"] = None # re-read next time
+
+def get_cached_ds_records(domain):
+	# Returns the cached DS records for the keys the domain was last signed with.
+	with ds_cache_lock:
+		return dict(load_ds_cache().get(domain, { }))
+
+def set_cached_ds_records(domain, ds_records):
+	# Replace the domain's cached DS records, which drops the records for keys
+	# that are no longer used.
+	with file_lock(DNSSEC_DS_CACHE_LOCK_FILE), ds_cache_lock:
+		domains = load_ds_cache()
+		if domains.get(domain) == ds_records:
+			return
+		domains = dict(domains)
+		domains[domain] = ds_records
+		save_ds_cache(domains)
+
+def prune_ds_cache(zones):
+	# Drop cached DS records for domains that are no longer zones.
+	with file_lock(DNSSEC_DS_CACHE_LOCK_FILE), ds_cache_lock:
+		domains = load_ds_cache()
+		if set(domains) - set(zones):
+			save_ds_cache({ domain: ds_records for domain, ds_records in domains.items() if domain in zones })
 
 ########################################################################
 
@@ -757,6 +1108,10 @@ def write_opendkim_tables(domains, env):
 		# Looks like OpenDKIM is not installed.
 		return False
 
+	# Write the domains in a stable order so that the tables only change
+	# when the domains do.
+	domains = sort_domains(domains, env)
+
 	config = {
 		# The SigningTable maps email addresses to a key in the KeyTable that
 		# specifies signing information for matching email addresses. Here we
@@ -783,16 +1138,10 @@ def write_opendkim_tables(domains, env):
 
 	did_update = False
 	for filename, content in config.items():
-		# Don't write the file if it doesn't need an update.
-		if os.path.exists("/etc/opendkim/" + filename):
-			with open("/etc/opendkim/" + filename, encoding="utf-8") as f:
-				if f.read() == content:
-					continue
-
-		# The contents needs to change.
-		with open("/etc/opendkim/" + filename, "w", encoding="utf-8") as f:
-			f.write(content)
-		did_update = True
+		# Don't write the file if it doesn't need an update. Otherwise replace
+		# it atomically so opendkim never reads a partial table.
+		if write_file_if_changed("/etc/opendkim/" + filename, content):
+			did_update = True
 
 	# Return whether the files changed. If they didn't change, there's
 	# no need to kick the opendkim process.
@@ -800,16 +1149,68 @@ def write_opendkim_tables(domains, env):
 
 ########################################################################
 
+class CustomDNSRecords(tuple):
+	# An immutable sequence of (qname, rtype, value) tuples for the custom DNS
+	# records in custom.yaml, in the order they are in the file, with indexes
+	# for finding the records for a qname, or for a domain and its subdomains,
+	# without scanning all of them. The indexes are built when first used.
+
+	def get_values(self, qname, rtype):
+		# Returns the values of the records with the given qname and rtype.
+		if not hasattr(self, "_by_qname_rtype"):
+			by_qname_rtype = { }
+			for qname1, rtype1, value in self:
+				by_qname_rtype.setdefault((qname1, rtype1), []).append(value)
+			self._by_qname_rtype = by_qname_rtype
+		return self._by_qname_rtype.get((qname, rtype), [])
+
+	def get_records_within(self, domain):
+		# Returns the records whose qname is domain or a subdomain of it.
+		if not hasattr(self, "_by_domain"):
+			by_domain = { }
+			for record in self:
+				labels = record[0].split(".")
+				for i in range(len(labels)):
+					by_domain.setdefault(".".join(labels[i:]), []).append(record)
+			self._by_domain = by_domain
+		return self._by_domain.get(domain, [])
+
+custom_dns_cache_lock = threading.Lock()
+custom_dns_cache = { }
+
 def get_custom_dns_config(env, only_real_records=False):
+	# Returns a CustomDNSRecords of the (qname, rtype, value) records in
+	# custom.yaml. The parsed file is kept until the file changes, and within
+	# a configuration snapshot the same records are returned every time.
+	records = memoized(env, "custom_dns", lambda: load_custom_dns_config(env))
+	if only_real_records:
+		return CustomDNSRecords(record for record in records if record[0] != "_secondary_nameserver") # skip fake record
+	return records
+
+def load_custom_dns_config(env):
+	fn = os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml')
+	try:
+		st = os.stat(fn)
+		stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+	except OSError:
+		stat = None
+	with custom_dns_cache_lock:
+		if fn in custom_dns_cache and custom_dns_cache[fn][0] == stat:
+			return custom_dns_cache[fn][1]
+	records = CustomDNSRecords(read_custom_dns_config(env))
+	with custom_dns_cache_lock:
+		custom_dns_cache[fn] = (stat, records)
+	return records
+
+def read_custom_dns_config(env):
 	try:
 		with open(os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml'), encoding="utf-8") as f:
 			custom_dns = rtyaml.load(f)
 		if not isinstance(custom_dns, dict): raise ValueError # caught below
 	except:
-		return [ ]
+		return
 
 	for qname, value in custom_dns.items():
-		if qname == "_secondary_nameserver" and only_real_records: continue # skip fake record
 
 		# Short form. Mapping a domain name to a string is short-hand
 		# for creating A records.
@@ -835,6 +1236,10 @@ def get_custom_dns_config(env, only_real_records=False):
 				raise ValueError
 
 def filter_custom_records(domain, custom_dns_iter):
+	if domain is not None and isinstance(custom_dns_iter, CustomDNSRecords):
+		# Use the index rather than looking at every record.
+		custom_dns_iter = custom_dns_iter.get_records_within(domain)
+
 	for qname, rtype, value in custom_dns_iter:
 		# We don't count the secondary nameserver config (if present) as a record - that would just be
 		# confusing to users. Instead it is accessed/manipulated directly via (get/set)_custom_dns_config.
@@ -884,9 +1289,14 @@ def write_custom_dns_config(config, env):
 
 	# Write.
 	config_yaml = rtyaml.dump(dns)
-	with open(os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml'), "w", encoding="utf-8") as f:
+	fn = os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml')
+	with open(fn, "w", encoding="utf-8") as f:
 		f.write(config_yaml)
+	with custom_dns_cache_lock:
+		custom_dns_cache.pop(fn, None)
+	forget_memoized(env, "custom_dns", "dns_domains", "dns_zones", "web_domains")
 
+@update_lock()
 def set_custom_dns_record(qname, rtype, value, action, env):
 	# validate qname
 	for zone, _fn in get_dns_zones(env):
@@ -984,6 +1394,9 @@ def get_secondary_dns(custom_dns, mode=None):
 	resolver.timeout = 10
 	resolver.lifetime = 10
 
+	if isinstance(custom_dns, CustomDNSRecords):
+		custom_dns = custom_dns.get_records_within('_secondary_nameserver')
+
 	values = []
 	for qname, _rtype, value in custom_dns:
 		if qname != '_secondary_nameserver': continue
@@ -1024,6 +1437,7 @@ def get_secondary_dns(custom_dns, mode=None):
 
 	return values
 
+@update_lock()
 def set_secondary_dns(hostnames, env):
 	if len(hostnames) > 0:
 		# Validate that all hostnames are valid and that all zone-xfer IP addresses are valid.
@@ -1064,9 +1478,9 @@ def set_secondary_dns(hostnames, env):
 
 
 def get_custom_dns_records(custom_dns, qname, rtype):
-	for qname1, rtype1, value in custom_dns:
-		if qname1 == qname and rtype1 == rtype:
-			yield value
+	if isinstance(custom_dns, CustomDNSRecords):
+		return iter(custom_dns.get_values(qname, rtype))
+	return (value for qname1, rtype1, value in custom_dns if qname1 == qname and rtype1 == rtype)
 
 ########################################################################
 
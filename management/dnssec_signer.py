@@ -0,0 +1,238 @@
+# Signs DNS zones in-process using dnspython, as an alternative to running
+# ldns-signzone. It's used when DNSSEC_SIGNING_ENGINE=dnspython is set in
+# /etc/mailinabox.conf, unless the installed dnspython can't sign zones (see
+# get_dnssec_signing_engine in dns_update).
+#
+# Zones are signed with NSEC3 using SHA-1 with no salt, no additional
+# iterations and no opt-out (see RFC 9276). Keys are read from the key files
+# generated during setup once and reused for every zone. When a zone is
+# signed again, signatures in the previous signed zone file are kept for the
+# record sets that haven't changed unless they are close to expiring, so a
+# small change to a large zone only signs what changed.
+
+import base64, datetime, os, threading
+
+import dns.dnssec, dns.exception, dns.name, dns.rdata, dns.rdataclass, dns.rdatatype, dns.zone
+
+from utils import write_file_atomic
+
+NSEC3PARAM = "1 0 0 -" # SHA-1, no flags, no additional iterations, no salt
+SIGNATURE_LIFETIME = datetime.timedelta(days=30)
+
+# Signatures from the previous signed zone are kept if they are valid for at
+# least this long. It must be more than the three days before the expiration
+# of the SOA's signature at which write_nsd_zone has the zone re-signed, and
+# the SOA's signature never expires later than any other signature.
+MIN_REUSED_SIGNATURE_LIFETIME = datetime.timedelta(days=7)
+
+########################################################################
+
+loaded_keys = { }
+loaded_keys_lock = threading.Lock()
+
+def load_key(key_fn):
+	# Returns the (private key, DNSKEY rdata) for the key pair in the
+	# key_fn + ".private" and key_fn + ".key" files, which are in the
+	# format ldns-keygen writes. Keys are cached until the files change.
+	stat = tuple((st.st_mtime_ns, st.st_size) for st in (os.stat(key_fn + ".key"), os.stat(key_fn + ".private")))
+	with loaded_keys_lock:
+		if key_fn in loaded_keys and loaded_keys[key_fn][0] == stat:
+			return loaded_keys[key_fn][1]
+	key = (read_private_key(key_fn + ".private"), read_dnskey(key_fn + ".key"))
+	with loaded_keys_lock:
+		loaded_keys[key_fn] = (stat, key)
+	return key
+
+def read_dnskey(fn):
+	# The .key file has a DNSKEY record, e.g. "_domain_.	IN	DNSKEY	257 3 13 ...".
+	with open(fn, encoding="utf-8") as f:
+		for line in f:
+			fields = line.split(";")[0].split()
+			if "DNSKEY" in fields:
+				rdata = " ".join(fields[fields.index("DNSKEY") + 1:])
+				return dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.DNSKEY, rdata)
+	msg = f"{fn} does not contain a DNSKEY record."
+	raise ValueError(msg)
+
+def read_private_key(fn):
+	# The .private file has "Name: value" lines in BIND's private key format.
+	fields = { }
+	with open(fn, encoding="utf-8") as f:
+		for line in f:
+			if ":" in line:
+				name, value = line.split(":", 1)
+				fields[name.strip()] = value.strip()
+
+	def read_int(name):
+		return int.from_bytes(base64.b64decode(fields[name]), "big")
+
+	from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+	algorithm = int(fields["Algorithm"].split()[0])
+	if algorithm in {5, 7, 8, 10}: # RSASHA1, RSASHA1-NSEC3-SHA1, RSASHA256, RSASHA512
+		return rsa.RSAPrivateNumbers(
+			p=read_int("Prime1"),
+			q=read_int("Prime2"),
+			d=read_int("PrivateExponent"),
+			dmp1=read_int("Exponent1"),
+			dmq1=read_int("Exponent2"),
+			iqmp=read_int("Coefficient"),
+			public_numbers=rsa.RSAPublicNumbers(read_int("PublicExponent"), read_int("Modulus")),
+		).private_key()
+	if algorithm == 13: # ECDSAP256SHA256
+		return ec.derive_private_key(read_int("PrivateKey"), ec.SECP256R1())
+	if algorithm == 14: # ECDSAP384SHA384
+		return ec.derive_private_key(read_int("PrivateKey"), ec.SECP384R1())
+	if algorithm == 15: # ED25519
+		return ed25519.Ed25519PrivateKey.from_private_bytes(base64.b64decode(fields["PrivateKey"]))
+	msg = f"{fn} uses a DNSSEC algorithm ({algorithm}) that isn't supported."
+	raise ValueError(msg)
+
+def make_ds_records(domain, key_fn):
+	# Returns DS records for the key in the same format as ldns-key2ds -n,
+	# using SHA-1, SHA-256 and SHA-384 digests.
+	_private_key, dnskey = load_key(key_fn)
+	return [
+		"{}.\t3600\tIN\tDS\t{}\n".format(domain, dns.dnssec.make_ds(domain + ".", dnskey, digest, policy=dns.dnssec.allow_all_policy).to_text())
+		for digest in ("SHA1", "SHA256", "SHA384")
+	]
+
+########################################################################
+
+def sign_zone(domain, zonefile, keys):
+	# Signs the zone in zonefile and writes it to zonefile + ".signed". keys is
+	# a list of (keytype, key_fn) where keytype is "KSK" or "ZSK" and key_fn is
+	# the path to the key files without the extension. Returns the time at which
+	# the first signature in the zone expires.
+	origin = dns.name.from_text(domain)
+	zone = dns.zone.from_file(zonefile, origin=origin, relativize=False)
+	soa = zone.get_rdataset(origin, dns.rdatatype.SOA)
+
+	keys = [(keytype, *load_key(key_fn)) for keytype, key_fn in keys]
+	ksks = [(private_key, dnskey) for keytype, private_key, dnskey in keys if keytype == "KSK"]
+	zsks = [(private_key, dnskey) for keytype, private_key, dnskey in keys if keytype == "ZSK"]
+
+	# Add the DNSKEY and NSEC3PARAM records at the zone apex.
+	dnskeys = zone.find_rdataset(origin, dns.rdatatype.DNSKEY, create=True)
+	for _keytype, _private_key, dnskey in keys:
+		dnskeys.add(dnskey, soa.ttl)
+	zone.find_rdataset(origin, dns.rdatatype.NSEC3PARAM, create=True).add(
+		dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.NSEC3PARAM, NSEC3PARAM), 0)
+
+	# Find the delegations to other name servers. Only their NS and DS records
+	# are in this zone, and only the DS records are signed. Anything below
+	# them is glue and isn't signed or included in the NSEC3 chain.
+	delegations = { name for name, node in zone.nodes.items()
+		if name != origin and node.get_rdataset(dns.rdataclass.IN, dns.rdatatype.NS) }
+	def is_glue(name):
+		return any(name.is_subdomain(d) and name != d for d in delegations)
+	def is_signed(name, rdtype):
+		return rdtype not in {dns.rdatatype.RRSIG, dns.rdatatype.NSEC3} and (name not in delegations or rdtype == dns.rdatatype.DS)
+
+	add_nsec3_records(zone, origin, soa, delegations, is_glue, is_signed)
+
+	# Sign the record sets, re-using signatures from the last time the zone
+	# was signed for record sets that haven't changed.
+	now = datetime.datetime.now(datetime.timezone.utc)
+	expiration = now + SIGNATURE_LIFETIME
+	previous = read_previous_signatures(zonefile + ".signed", origin)
+	first_expiration = expiration
+	for name, node in list(zone.nodes.items()):
+		if is_glue(name): continue
+		for rdataset in list(node.rdatasets):
+			if rdataset.rdtype == dns.rdatatype.SOA: continue # signed last, below
+			if not is_signed(name, rdataset.rdtype) and rdataset.rdtype != dns.rdatatype.NSEC3: continue
+			signing_keys = ksks if rdataset.rdtype == dns.rdatatype.DNSKEY else zsks
+			signatures = get_reusable_signatures(previous.get((name, rdataset.rdtype)), rdataset, signing_keys, now + MIN_REUSED_SIGNATURE_LIFETIME)
+			if signatures is not None:
+				first_expiration = min(first_expiration, *(datetime.datetime.fromtimestamp(s.expiration, datetime.timezone.utc) for s in signatures))
+			else:
+				signatures = sign_rdataset(name, rdataset, signing_keys, origin, now, expiration)
+			add_signatures(node, rdataset, signatures)
+
+	# The SOA changes every time the zone is signed. Its signature expires when
+	# the first re-used signature does, so that write_nsd_zone, which looks at
+	# the SOA's signature, re-signs the zone before any signature expires.
+	add_signatures(zone.get_node(origin), soa, sign_rdataset(origin, soa, zsks, origin, now, first_expiration))
+
+	# Write the signed zone.
+	write_file_atomic(zonefile + ".signed", zone.to_text(sorted=True, relativize=False))
+
+	return first_expiration
+
+def add_nsec3_records(zone, origin, soa, delegations, is_glue, is_signed):
+	# Hash every authoritative name, including empty non-terminals (names with
+	# no records but with names below them), and link the hashes in a chain.
+	names = { name for name in zone.nodes if not is_glue(name) }
+	for name in list(names):
+		parent = name
+		while parent != origin:
+			parent = parent.parent()
+			names.add(parent)
+
+	hashed_names = { }
+	for name in names:
+		types = set()
+		node = zone.get_node(name)
+		if node is not None:
+			types = { rdataset.rdtype for rdataset in node.rdatasets
+				if name not in delegations or rdataset.rdtype in {dns.rdatatype.NS, dns.rdatatype.DS} }
+			if any(is_signed(name, rdtype) for rdtype in types):
+				types.add(dns.rdatatype.RRSIG)
+		hashed_names[dns.dnssec.nsec3_hash(name, None, 0, 1)] = types
+
+	# The NSEC3 TTL is the lesser of the SOA's TTL and its minimum field (RFC 9077).
+	ttl = min(soa.ttl, soa[0].minimum)
+	hashes = sorted(hashed_names)
+	for i, h in enumerate(hashes):
+		next_hash = hashes[(i + 1) % len(hashes)]
+		types = " ".join(sorted((dns.rdatatype.to_text(t) for t in hashed_names[h]), key=dns.rdatatype.from_text))
+		rdata = dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.NSEC3, f"{NSEC3PARAM} {next_hash} {types}")
+		zone.find_rdataset(dns.name.Name((h.lower(),)).concatenate(origin), dns.rdatatype.NSEC3, create=True).add(rdata, ttl)
+
+def sign_rdataset(name, rdataset, keys, origin, inception, expiration):
+	return [
+		dns.dnssec.sign((name, rdataset), private_key, origin, dnskey,
+			inception=inception, expiration=expiration, policy=dns.dnssec.allow_all_policy)
+		for private_key, dnskey in keys
+	]
+
+def add_signatures(node, rdataset, signatures):
+	rrsigs = node.find_rdataset(dns.rdataclass.IN, dns.rdatatype.RRSIG, rdataset.rdtype, create=True)
+	for signature in signatures:
+		rrsigs.add(signature, rdataset.ttl)
+
+def read_previous_signatures(signed_fn, origin):
+	# Returns a mapping from (name, rdtype) to the record set and its signatures
+	# in the previous signed zone file.
+	try:
+		zone = dns.zone.from_file(signed_fn, origin=origin, relativize=False, check_origin=False)
+	except (OSError, dns.exception.DNSException):
+		return { }
+	previous = { }
+	for name, node in zone.nodes.items():
+		signatures = { rdataset.covers: list(rdataset) for rdataset in node.rdatasets if rdataset.rdtype == dns.rdatatype.RRSIG }
+		for rdataset in node.rdatasets:
+			if rdataset.rdtype != dns.rdatatype.RRSIG:
+				previous[(name, rdataset.rdtype)] = (rdataset, signatures.get(rdataset.rdtype, []))
+	return previous
+
+def get_reusable_signatures(previous, rdataset, keys, valid_until):
+	# Returns the previous signatures of the record set, one for each key, if the
+	# record set is unchanged and they are all valid until at least valid_until.
+	# Otherwise returns None.
+	if previous is None:
+		return None
+	previous_rdataset, previous_signatures = previous
+	if previous_rdataset != rdataset or previous_rdataset.ttl != rdataset.ttl:
+		return None
+	signatures = []
+	for _private_key, dnskey in keys:
+		key_tag = dns.dnssec.key_id(dnskey)
+		for signature in previous_signatures:
+			if signature.key_tag == key_tag and signature.algorithm == dnskey.algorithm \
+				and signature.original_ttl == rdataset.ttl and signature.expiration >= valid_until.timestamp():
+				signatures.append(signature)
+				break
+		else:
+			return None
+	return signatures
@@ -0,0 +1,11 @@
+# gunicorn settings for the management daemon. See the start script
+# written by setup/management.sh.
+
+def post_worker_init(worker):
+	# Read every mailbox's size in the background once the worker has
+	# started, so that the users page is quick to load the first time it's
+	# opened even on boxes with many mailboxes. The sizes are cached in each
+	# worker's memory, so each worker reads them, but the worker can serve
+	# requests while it does and the master isn't held up.
+	import mailconfig, utils
+	mailconfig.start_warming_mailbox_usage_cache(utils.load_environment())
@@ -0,0 +1,161 @@
+# Runs long management operations, like the status checks or provisioning
+# certificates, in the background so that an API request doesn't have to
+# wait for them. Submitting a job returns a job ID right away, and clients
+# then poll for the job's progress and result.
+#
+# The daemon runs several worker processes and a client's polls may reach
+# any of them, so jobs are recorded in a small SQLite database shared by
+# all of them. Each job runs on a thread in the process that accepted it.
+
+import json, os, secrets, sqlite3, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_JOBS_PATH = '/var/lib/mailinabox/jobs.sqlite'
+
+# The job running on the current thread, so that the job's code can report
+# progress without it being passed down.
+_current_job = threading.local()
+
+def report_progress(progress):
+	# Record the progress of the job running on this thread, if any. progress
+	# can be anything that can be turned into JSON. Does nothing outside of jobs.
+	job_queue = getattr(_current_job, "queue", None)
+	if job_queue is not None:
+		job_queue.update(_current_job.id, progress=progress)
+
+class JobQueue:
+	def __init__(self, path=DEFAULT_JOBS_PATH, max_workers=2, max_age_seconds=24*60*60):
+		self.path = path
+		self.max_age_seconds = max_age_seconds
+		self.local = threading.local()
+		self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+
+		os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+		conn = self.connect()
+		with conn:
+			conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+				id TEXT PRIMARY KEY, name TEXT NOT NULL, status TEXT NOT NULL,
+				progress TEXT, result TEXT, error TEXT,
+				pid INTEGER NOT NULL, created REAL NOT NULL, updated REAL NOT NULL,
+				pid_start TEXT)""")
+			# Databases created before pid_start was added don't have it.
+			if "pid_start" not in [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]:
+				conn.execute("ALTER TABLE jobs ADD COLUMN pid_start TEXT")
+
+	def connect(self):
+		# Use one connection per thread, and a new one after a fork.
+		conn = getattr(self.local, "conn", None)
+		if conn is None or self.local.pid != os.getpid():
+			conn = sqlite3.connect(self.path, timeout=15)
+			conn.execute("PRAGMA journal_mode=WAL")
+			self.local.conn = conn
+			self.local.pid = os.getpid()
+		return conn
+
+	def submit(self, name, func, *args, **kwargs):
+		# Queue func(*args, **kwargs) to run in the background and return the new
+		# job's ID. Its return value, which must be something that can be turned
+		# into JSON, becomes the job's result. If it raises an exception, the job
+		# fails with the exception's message as its error.
+		job_id = secrets.token_hex(16)
+		now = time.time()
+		conn = self.connect()
+		with conn:
+			conn.execute("DELETE FROM jobs WHERE updated<? AND status NOT IN ('queued', 'running')", (now - self.max_age_seconds,))
+			conn.execute("INSERT INTO jobs (id, name, status, pid, pid_start, created, updated) VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+				(job_id, name, os.getpid(), get_process_start(os.getpid()), now, now))
+		self.executor.submit(self.run, job_id, func, args, kwargs)
+		return job_id
+
+	def run(self, job_id, func, args, kwargs):
+		_current_job.queue = self
+		_current_job.id = job_id
+		self.update(job_id, status="running")
+		try:
+			result = func(*args, **kwargs)
+		except Exception as e:
+			self.update(job_id, status="failed", error=str(e) or e.__class__.__name__)
+		else:
+			self.update(job_id, status="finished", result=result)
+		finally:
+			_current_job.queue = None
+
+			# Don't hold on to a transaction on this thread's users database
+			# connection between jobs.
+			from mailconfig import release_database
+			release_database()
+
+	def update(self, job_id, status=None, progress=None, result=None, error=None):
+		fields = { "updated": time.time() }
+		if status is not None: fields["status"] = status
+		if progress is not None: fields["progress"] = json.dumps(progress)
+		if result is not None: fields["result"] = json.dumps(result)
+		if error is not None: fields["error"] = error
+		conn = self.connect()
+		with conn:
+			conn.execute("UPDATE jobs SET " + ", ".join(f"{field}=?" for field in fields) + " WHERE id=?",
+				(*fields.values(), job_id))
+
+	def get(self, job_id):
+		# Returns a dict describing the job, or None if there is no such job.
+		row = self.connect().execute("SELECT id, name, status, progress, result, error, pid, created, updated, pid_start FROM jobs WHERE id=?", (job_id,)).fetchone()
+		if row is None:
+			return None
+		job = {
+			"id": row[0],
+			"name": row[1],
+			"status": row[2],
+			"progress": json.loads(row[3]) if row[3] is not None else None,
+			"result": json.loads(row[4]) if row[4] is not None else None,
+			"error": row[5],
+			"created": row[7],
+			"updated": row[8],
+		}
+
+		# If the process running the job has gone away (e.g. the daemon was
+		# restarted), the job will never finish.
+		if job["status"] in {"queued", "running"} and not is_process_running(row[6], row[9]):
+			job["status"] = "failed"
+			job["error"] = "The job was interrupted."
+			self.update(job_id, status=job["status"], error=job["error"])
+
+		return job
+
+	def wait(self, job_id, timeout):
+		# Returns the job once it has finished or failed, or as it is after
+		# timeout seconds, whichever comes first.
+		deadline = time.time() + timeout
+		while True:
+			job = self.get(job_id)
+			if job is None or job["status"] in {"finished", "failed"} or time.time() >= deadline:
+				return job
+			time.sleep(0.5)
+
+def get_process_start(pid):
+	# Returns a string that identifies the process with the given ID apart
+	# from any other process that has had or will have the same ID: the boot
+	# ID of the system and the time the process started after boot. Returns
+	# None if it can't be read (e.g. there is no such process or no /proc).
+	try:
+		with open("/proc/sys/kernel/random/boot_id", encoding="ascii") as f:
+			boot_id = f.read().strip()
+		with open(f"/proc/{pid}/stat", encoding="utf-8", errors="replace") as f:
+			# The process's name, in parentheses, may contain spaces. The
+			# start time is the 22nd field, the 20th after the name.
+			start_time = f.read().rsplit(")", 1)[1].split()[19]
+	except (OSError, IndexError):
+		return None
+	return f"{boot_id}:{start_time}"
+
+def is_process_running(pid, pid_start=None):
+	# If the job recorded when its process started, compare that so that a
+	# new process that got the same ID after a restart isn't mistaken for it.
+	if pid_start is not None:
+		return get_process_start(pid) == pid_start
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
@@ -9,7 +9,7 @@
 # Python 3 in setup/questions.sh to validate the email
 # address entered by the user.
 
-import os, sqlite3, re
+import os, sqlite3, re, threading
 
 import utils
 from email_validator import validate_email as validate_email_, EmailNotValidError
@@ -90,18 +90,67 @@ def is_dcv_address(email):
 	email = email.lower()
 	return any(email.startswith((localpart + "@", localpart + "+")) for localpart in ("admin", "administrator", "postmaster", "hostmaster", "webmaster", "abuse"))
 
+# Connections to the users database are opened once per thread and then
+# reused, rather than reconnecting for every query. A gunicorn sync worker
+# handles one request at a time on a single thread, so this amounts to one
+# connection per worker. Connections are keyed by process ID too because
+# an SQLite connection must not be used across a fork (the status checks
+# run in a forked worker pool).
+_database_connections = threading.local()
+
+def get_database_connection(env):
+	connections = _database_connections.__dict__.setdefault("connections", { })
+	key = (os.getpid(), env["STORAGE_ROOT"] + "/mail/users.sqlite")
+	if key not in connections:
+		# Wait for other writers (Postfix, Dovecot, Roundcube, or another
+		# worker) instead of failing immediately with "database is locked",
+		# and keep a larger cache of prepared statements since we issue
+		# the same handful of queries over and over.
+		#
+		# The journal mode is left alone. Switching users.sqlite to WAL
+		# would require every process that reads it, including the mail
+		# daemons running under other users, to be able to write the
+		# shared-memory file next to it.
+		connections[key] = sqlite3.connect(key[1], timeout=15, cached_statements=256)
+	return connections[key]
+
 def open_database(env, with_connection=False):
-	conn = sqlite3.connect(env["STORAGE_ROOT"] + "/mail/users.sqlite")
+	conn = get_database_connection(env)
 	if not with_connection:
 		return conn.cursor()
 	return conn, conn.cursor()
 
+def get_database_version(env):
+	# Returns a value that changes whenever the users database changes, whether
+	# through this connection or by another process, so that things read from
+	# it can be cached until then. PRAGMA data_version only reflects changes
+	# made by other connections, so this connection's change count is included.
+	conn = get_database_connection(env)
+	return (id(conn), conn.total_changes, conn.execute("PRAGMA data_version").fetchone()[0])
+
+def release_database():
+	# Roll back anything left uncommitted on this thread's connections, e.g.
+	# by a request that failed part way through, so that a reused connection
+	# doesn't hold a lock on the database between requests.
+	for (pid, _fn), conn in _database_connections.__dict__.get("connections", { }).items():
+		if pid == os.getpid() and conn.in_transaction:
+			conn.rollback()
+
+def close_database():
+	# Close this thread's database connections. Connections inherited from
+	# a parent process are left alone since they belong to the parent.
+	connections = _database_connections.__dict__.get("connections", { })
+	for key in [key for key in connections if key[0] == os.getpid()]:
+		connections.pop(key).close()
+
 def get_mail_users(env):
 	# Returns a flat, sorted list of all user accounts.
-	c = open_database(env)
-	c.execute('SELECT email FROM users')
-	users = [ row[0] for row in c.fetchall() ]
-	return utils.sort_email_addresses(users, env)
+	def query():
+		c = open_database(env)
+		c.execute('SELECT email FROM users')
+		users = [ row[0] for row in c.fetchall() ]
+		return utils.sort_email_addresses(users, env)
+	return list(utils.memoized(env, "mail_users", query))
 
 def sizeof_fmt(num):
 	for unit in ['','K','M','G','T']:
@@ -114,6 +163,68 @@ def sizeof_fmt(num):
 
 	return str(num)
 
+# Dovecot's maildirsize files are cached after parsing, keyed by path, along
+# with the file's modification time and size at the time it was read. Dovecot
+# appends to the file whenever a mailbox's usage changes and rewrites it when
+# it recalculates quota, either of which changes the time and size, so a file
+# is re-read only if its mailbox changed since we last looked at it. Files of
+# mailboxes that no longer exist are dropped by prune_mailbox_usage_cache.
+_maildirsize_cache = { }
+
+def get_mailbox_usage(dirsize_file):
+	# Returns a tuple of (quota, used) in bytes read from a maildirsize file.
+	# Raises OSError if the file does not exist and ValueError if it is not
+	# in the expected format.
+	try:
+		st = os.stat(dirsize_file)
+	except OSError:
+		_maildirsize_cache.pop(dirsize_file, None)
+		raise
+	stamp = (st.st_mtime_ns, st.st_size)
+	cached = _maildirsize_cache.get(dirsize_file)
+	if cached is not None and cached[0] == stamp:
+		return cached[1]
+
+	box_size = 0
+	with open(dirsize_file, encoding="utf-8") as f:
+		box_quota = int(f.readline().split('S')[0])
+		for line in f:
+			(size, _count) = line.split(' ')
+			box_size += int(size)
+
+	_maildirsize_cache[dirsize_file] = (stamp, (box_quota, box_size))
+	return (box_quota, box_size)
+
+def prune_mailbox_usage_cache(dirsize_files):
+	# Forget the cached maildirsize files that aren't in dirsize_files, i.e.
+	# those of users that have been removed.
+	for fn in set(_maildirsize_cache) - set(dirsize_files):
+		_maildirsize_cache.pop(fn, None)
+
+def warm_mailbox_usage_cache(env):
+	# Read every user's maildirsize file into the cache above so the first
+	# load of the users page after the daemon starts is as fast as the rest.
+	# Errors are ignored here. They'll be reported when the page is loaded.
+	dirsize_files = []
+	for email in get_mail_users(env):
+		user, domain = email.split("@", 1)
+		dirsize_files.append(os.path.join(env['STORAGE_ROOT'], f'mail/mailboxes/{domain}/{user}/maildirsize'))
+		try:
+			get_mailbox_usage(dirsize_files[-1])
+		except (OSError, ValueError):
+			pass
+	prune_mailbox_usage_cache(dirsize_files)
+
+def start_warming_mailbox_usage_cache(env):
+	# Warm the cache on a background thread so that requests can be served in
+	# the meantime. The thread's database connection is closed when it's done.
+	def warm():
+		try:
+			warm_mailbox_usage_cache(env)
+		finally:
+			close_database()
+	threading.Thread(target=warm, daemon=True).start()
+
 def get_mail_users_ex(env, with_archived=False):
 	# Returns a complex data structure of all user accounts, optionally
 	# including archived (status="inactive") accounts.
@@ -136,6 +247,7 @@ def get_mail_users_ex(env, with_archived=False):
 	# Get users and their privileges.
 	users = []
 	active_accounts = set()
+	dirsize_files = []
 	c = open_database(env)
 	c.execute('SELECT email, privileges, quota FROM users')
 	for email, privileges, quota in c.fetchall():
@@ -147,11 +259,8 @@ def get_mail_users_ex(env, with_archived=False):
 		percent = ''
 		try:
 			dirsize_file = os.path.join(env['STORAGE_ROOT'], f'mail/mailboxes/{domain}/{user}/maildirsize')
-			with open(dirsize_file, encoding="utf-8") as f:
-				box_quota = int(f.readline().split('S')[0])
-				for line in f:
-					(size, _count) = line.split(' ')
-					box_size += int(size)
+			dirsize_files.append(dirsize_file)
+			box_quota, box_size = get_mailbox_usage(dirsize_file)
 
 			try:
 				percent = (box_size / box_quota) * 100
@@ -177,6 +286,9 @@ def get_mail_users_ex(env, with_archived=False):
 		}
 		users.append(user)
 
+	# Forget the sizes of mailboxes of users that no longer exist.
+	prune_mailbox_usage_cache(dirsize_files)
+
 	# Add in archived accounts.
 	if with_archived:
 		root = os.path.join(env['STORAGE_ROOT'], 'mail/mailboxes')
@@ -228,12 +340,14 @@ def get_admins(env):
 
 def get_mail_aliases(env):
 	# Returns a sorted list of tuples of (address, forward-tos, permitted-senders, auto).
-	c = open_database(env)
-	c.execute('SELECT source, destination, permitted_senders, 0 as auto FROM aliases UNION SELECT source, destination, permitted_senders, 1 as auto FROM auto_aliases')
-	aliases = { row[0]: row for row in c.fetchall() } # make dict
+	def query():
+		c = open_database(env)
+		c.execute('SELECT source, destination, permitted_senders, 0 as auto FROM aliases UNION SELECT source, destination, permitted_senders, 1 as auto FROM auto_aliases')
+		aliases = { row[0]: row for row in c.fetchall() } # make dict
 
-	# put in a canonical order: sort by domain, then by email address lexicographically
-	return [ aliases[address] for address in utils.sort_email_addresses(aliases.keys(), env) ]
+		# put in a canonical order: sort by domain, then by email address lexicographically
+		return [ aliases[address] for address in utils.sort_email_addresses(aliases.keys(), env) ]
+	return list(utils.memoized(env, "mail_aliases", query))
 
 def get_mail_aliases_ex(env):
 	# Returns a complex data structure of all mail aliases, similar
@@ -299,30 +413,44 @@ def get_domain(emailaddr, as_unicode=True):
 			pass
 	return ret
 
-def get_mail_domains(env, filter_aliases=lambda alias : True, users_only=False):
+def get_mail_domains(env, filter_aliases=None, users_only=False):
 	# Returns the domain names (IDNA-encoded) of all of the email addresses
 	# configured on the system. If users_only is True, only return domains
-	# with email addresses that correspond to user accounts. Exclude Unicode
-	# forms of domain names listed in the automatic aliases table.
-	domains = []
-	domains.extend([get_domain(login, as_unicode=False) for login in get_mail_users(env)])
-	if not users_only:
-		domains.extend([get_domain(address, as_unicode=False) for address, _, _, auto in get_mail_aliases(env) if filter_aliases(address) and not auto ])
-	return set(domains)
-
-def add_mail_user(email, pw, privs, quota, env):
-	# validate email
+	# with email addresses that correspond to user accounts. If filter_aliases
+	# is given, only aliases for which it returns True are included. Exclude
+	# Unicode forms of domain names listed in the automatic aliases table.
+	def query():
+		domains = []
+		domains.extend([get_domain(login, as_unicode=False) for login in get_mail_users(env)])
+		if not users_only:
+			domains.extend([get_domain(address, as_unicode=False) for address, _, _, auto in get_mail_aliases(env) if (filter_aliases is None or filter_aliases(address)) and not auto ])
+		return set(domains)
+	if filter_aliases is not None:
+		return query()
+	return set(utils.memoized(env, ("mail_domains", users_only), query))
+
+def validate_mail_user_address(email, env, first_user=None):
+	# validate email. first_user says whether this is the first account on
+	# the box, and is looked up if not given.
 	if email.strip() == "":
 		return ("No email address provided.", 400)
 	if not validate_email(email):
 		return ("Invalid email address.", 400)
 	if not validate_email(email, mode='user'):
 		return ("User account email addresses may only use the lowercase ASCII letters a-z, the digits 0-9, underscore (_), hyphen (-), and period (.).", 400)
-	if is_dcv_address(email) and len(get_mail_users(env)) > 0:
+	if first_user is None:
+		first_user = len(get_mail_users(env)) == 0
+	if is_dcv_address(email) and not first_user:
 		# Make domain control validation hijacking a little harder to mess up by preventing the usual
 		# addresses used for DCV from being user accounts. Except let it be the first account because
 		# during box setup the user won't know the rules.
 		return ("You may not make a user account for that address because it is frequently used for domain control validation. Use an alias instead if necessary.", 400)
+	return None
+
+def add_mail_user(email, pw, privs, quota, env):
+	# validate email
+	validation = validate_mail_user_address(email, env)
+	if validation: return validation
 
 	# validate password
 	validate_password(pw)
@@ -355,6 +483,7 @@ def add_mail_user(email, pw, privs, quota, env):
 		c.execute("INSERT INTO users (email, password, privileges, quota) VALUES (?, ?, ?, ?)",
 			(email, pw, "\n".join(privs), quota))
 	except sqlite3.IntegrityError:
+		conn.rollback()
 		return ("User already exists.", 400)
 
 	# write databasebefore next step
@@ -376,6 +505,7 @@ def set_mail_password(email, pw, env):
 	conn, c = open_database(env, with_connection=True)
 	c.execute("UPDATE users SET password=? WHERE email=?", (pw, email))
 	if c.rowcount != 1:
+		conn.rollback()
 		return (f"That's not a user ({email}).", 400)
 	conn.commit()
 	return "OK"
@@ -384,7 +514,38 @@ def hash_password(pw):
 	# Turn the plain password into a Dovecot-format hashed password, meaning
 	# something like "{SCHEME}hashedpassworddata".
 	# http://wiki2.dovecot.org/Authentication/PasswordSchemes
-	return utils.shell('check_output', ["/usr/bin/doveadm", "pw", "-s", "SHA512-CRYPT", "-p", pw]).strip()
+	# This produces the same SHA512-CRYPT hashes as `doveadm pw -s SHA512-CRYPT`
+	# without starting a process for each one.
+	import sha512_crypt
+	return sha512_crypt.hash_password(pw)
+
+def hash_passwords(pws):
+	# Hash many passwords at once, e.g. for a bulk import. Hashing is CPU-bound
+	# pure Python, so spread it over several processes rather than threads.
+	# sha512_crypt is imported before forking so the processes don't have to
+	# import it themselves.
+	import sha512_crypt # noqa: F401
+	workers = min(len(pws), os.cpu_count() or 1)
+	if workers <= 1:
+		return [hash_password(pw) for pw in pws]
+	from concurrent.futures import ProcessPoolExecutor
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		return list(pool.map(hash_password, pws, chunksize=-(-len(pws) // (workers * 4))))
+
+def verify_password(pw, pw_hash):
+	# Checks a plain password against a Dovecot-format hashed password, returning
+	# True or False. SHA512-CRYPT hashes, which is what we create, are checked here.
+	# Let doveadm check anything else, e.g. hashes from older installs.
+	import sha512_crypt, subprocess
+	try:
+		return sha512_crypt.verify_password(pw, pw_hash)
+	except ValueError:
+		pass
+	try:
+		utils.shell('check_call', ["/usr/bin/doveadm", "pw", "-p", pw, "-t", pw_hash])
+	except subprocess.CalledProcessError:
+		return False
+	return True
 
 
 def get_mail_quota(email, env):
@@ -405,6 +566,7 @@ def set_mail_quota(email, quota, env):
 	conn, c = open_database(env, with_connection=True)
 	c.execute("UPDATE users SET quota=? WHERE email=?", (quota, email))
 	if c.rowcount != 1:
+		conn.rollback()
 		return (f"That's not a user ({email}).", 400)
 	conn.commit()
 
@@ -456,12 +618,135 @@ def remove_mail_user(email, env):
 	conn, c = open_database(env, with_connection=True)
 	c.execute("DELETE FROM users WHERE email=?", (email,))
 	if c.rowcount != 1:
+		conn.rollback()
 		return (f"That's not a user ({email}).", 400)
 	conn.commit()
 
 	# Update things in case any domains are removed.
 	return kick(env, "mail user removed")
 
+def get_bulk_field(row, field):
+	# Rows in bulk requests come from JSON or CSV, so normalize each field to a
+	# string. Lists (e.g. privileges in JSON) become \n-separated strings.
+	value = row.get(field)
+	if value is None:
+		return ""
+	if isinstance(value, list):
+		return "\n".join(str(v) for v in value)
+	return str(value)
+
+def bulk_error(i, email, msg):
+	return (f"Row {i} ({email or 'no email address'}): {msg} No changes were made.", 400)
+
+def bulk_update_mail_users(rows, env):
+	# Adds, updates, and removes many users at once, e.g. when moving a domain
+	# to this box. Each row has an action ("add", the default, "update", or
+	# "remove"), an email, and for add and update a password, privileges and
+	# quota. On update, blank fields are left unchanged. Every row is validated
+	# before anything is written so that a bad row leaves everything as it was.
+	# Then all rows are written in a single transaction and kick() runs once.
+	if len(rows) == 0:
+		return "No users were given. No changes were made."
+	existing_users = set(get_mail_users(env))
+	seen = set()
+	changes = []
+	for i, row in enumerate(rows, start=1):
+		action = get_bulk_field(row, "action").strip().lower() or "add"
+		email = get_bulk_field(row, "email").strip()
+		pw = get_bulk_field(row, "password")
+		privs = get_bulk_field(row, "privileges")
+		quota = get_bulk_field(row, "quota").strip()
+
+		if email in seen:
+			return bulk_error(i, email, "The address appears more than once.")
+		seen.add(email)
+
+		if action == "add":
+			# Like when adding a single user, only the first account on the
+			# box may use an address used for domain control validation.
+			first_user = len(existing_users) == 0 and not any(change[0] == "add" for change in changes)
+			validation = validate_mail_user_address(email, env, first_user=first_user)
+			if validation: return bulk_error(i, email, validation[0])
+			if email in existing_users:
+				return bulk_error(i, email, "User already exists.")
+		elif action in {"update", "remove"}:
+			if email not in existing_users:
+				return bulk_error(i, email, f"That's not a user ({email}).")
+			if action == "remove":
+				changes.append((action, email, None, None, None))
+				continue
+		else:
+			return bulk_error(i, email, f"Invalid action ({action}).")
+
+		# validate password, which is required for new users
+		if pw != "" or action == "add":
+			try:
+				validate_password(pw)
+			except ValueError as e:
+				return bulk_error(i, email, str(e))
+		else:
+			pw = None
+
+		# validate privileges
+		if privs.strip() != "" or action == "add":
+			privs = [p.strip() for p in re.split(r"[\n,]", privs) if p.strip() != ""]
+			for p in privs:
+				validation = validate_privilege(p)
+				if validation: return bulk_error(i, email, validation[0])
+			privs = "\n".join(privs)
+		else:
+			privs = None
+
+		# validate quota
+		if quota != "" or action == "add":
+			try:
+				quota = validate_quota(quota or '0')
+			except ValueError as e:
+				return bulk_error(i, email, str(e))
+		else:
+			quota = None
+
+		changes.append((action, email, pw, privs, quota))
+
+	# hash the passwords
+	hashes = iter(hash_passwords([change[2] for change in changes if change[2] is not None]))
+	changes = [
+		(action, email, next(hashes) if pw is not None else None, privs, quota)
+		for action, email, pw, privs, quota in changes
+	]
+
+	# write everything to the database in one transaction
+	conn, c = open_database(env, with_connection=True)
+	try:
+		for action, email, pw, privs, quota in changes:
+			if action == "add":
+				c.execute("INSERT INTO users (email, password, privileges, quota) VALUES (?, ?, ?, ?)",
+					(email, pw, privs, quota))
+			elif action == "update":
+				if pw is not None:
+					c.execute("UPDATE users SET password=? WHERE email=?", (pw, email))
+				if privs is not None:
+					c.execute("UPDATE users SET privileges=? WHERE email=?", (privs, email))
+				if quota is not None:
+					c.execute("UPDATE users SET quota=? WHERE email=?", (quota, email))
+			elif action == "remove":
+				c.execute("DELETE FROM users WHERE email=?", (email,))
+	except sqlite3.Error as e:
+		conn.rollback()
+		return (f"No changes were made because the database could not be updated: {e}", 500)
+	conn.commit()
+
+	# Let dovecot know about new and changed quotas. Each recalculation runs
+	# doveadm, so run several at once.
+	from concurrent.futures import ThreadPoolExecutor
+	with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+		list(pool.map(dovecot_quota_recalc, [email for action, email, pw, privs, quota in changes if action != "remove" and quota is not None]))
+
+	counts = { action: sum(1 for change in changes if change[0] == action) for action in ("add", "update", "remove") }
+
+	# Update things in case any domains are added or removed.
+	return kick(env, f"{counts['add']} mail users added, {counts['update']} updated, {counts['remove']} removed")
+
 def parse_privs(value):
 	return [p for p in value.split("\n") if p.strip() != ""]
 
@@ -502,12 +787,17 @@ def add_remove_mail_user_privilege(email, priv, action, env):
 	conn, c = open_database(env, with_connection=True)
 	c.execute("UPDATE users SET privileges=? WHERE email=?", ("\n".join(privs), email))
 	if c.rowcount != 1:
+		conn.rollback()
 		return ("Something went wrong.", 400)
 	conn.commit()
 
 	return "OK"
 
-def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exists=False, do_kick=True):
+def validate_mail_alias(address, forwards_to, permitted_senders, env, valid_logins=None):
+	# Validates and normalizes an alias. Returns the address, the comma-separated
+	# destinations, and the comma-separated permitted senders (or None) in the form
+	# they are stored in the database, or raises a ValueError.
+
 	# convert Unicode domain to IDNA
 	address = sanitize_idn_email_address(address)
 
@@ -518,9 +808,11 @@ def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exist
 	# validate address
 	address = address.strip()
 	if address == "":
-		return ("No email address provided.", 400)
+		msg = "No email address provided."
+		raise ValueError(msg)
 	if not validate_email(address, mode='alias'):
-		return (f"Invalid email address ({address}).", 400)
+		msg = f"Invalid email address ({address})."
+		raise ValueError(msg)
 
 	# validate forwards_to
 	validated_forwards_to = []
@@ -549,16 +841,19 @@ def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exist
 				# Strip any +tag from email alias and check privileges
 				privileged_email = re.sub(r"(?=\+)[^@]*(?=@)",'',email)
 				if not validate_email(email):
-					return (f"Invalid receiver email address ({email}).", 400)
+					msg = f"Invalid receiver email address ({email})."
+					raise ValueError(msg)
 				if is_dcv_source and not is_dcv_address(email) and "admin" not in get_mail_user_privileges(privileged_email, env, empty_on_error=True):
 					# Make domain control validation hijacking a little harder to mess up by
 					# requiring aliases for email addresses typically used in DCV to forward
 					# only to accounts that are administrators on this system.
-					return ("This alias can only have administrators of this system as destinations because the address is frequently used for domain control validation.", 400)
+					msg = "This alias can only have administrators of this system as destinations because the address is frequently used for domain control validation."
+					raise ValueError(msg)
 				validated_forwards_to.append(email)
 
 	# validate permitted_senders
-	valid_logins = get_mail_users(env)
+	if valid_logins is None:
+		valid_logins = get_mail_users(env)
 	validated_permitted_senders = []
 	permitted_senders = permitted_senders.strip()
 
@@ -569,25 +864,37 @@ def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exist
 			login = login.strip()
 			if login == "": continue
 			if login not in valid_logins:
-				return (f"Invalid permitted sender: {login} is not a user on this system.", 400)
+				msg = f"Invalid permitted sender: {login} is not a user on this system."
+				raise ValueError(msg)
 			validated_permitted_senders.append(login)
 
 	# Make sure the alias has either a forwards_to or a permitted_sender.
 	if len(validated_forwards_to) + len(validated_permitted_senders) == 0:
-		return ("The alias must either forward to an address or have a permitted sender.", 400)
-
-	# save to db
+		msg = "The alias must either forward to an address or have a permitted sender."
+		raise ValueError(msg)
 
 	forwards_to = ",".join(validated_forwards_to)
 
 	permitted_senders = None if len(validated_permitted_senders) == 0 else ",".join(validated_permitted_senders)
 
+	return address, forwards_to, permitted_senders
+
+def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exists=False, do_kick=True):
+	# validate
+	try:
+		address, forwards_to, permitted_senders = validate_mail_alias(address, forwards_to, permitted_senders, env)
+	except ValueError as e:
+		return (str(e), 400)
+
+	# save to db
+
 	conn, c = open_database(env, with_connection=True)
 	try:
 		c.execute("INSERT INTO aliases (source, destination, permitted_senders) VALUES (?, ?, ?)", (address, forwards_to, permitted_senders))
 		return_status = "alias added"
 	except sqlite3.IntegrityError:
 		if not update_if_exists:
+			conn.rollback()
 			return (f"Alias already exists ({address}).", 400)
 		c.execute("UPDATE aliases SET destination = ?, permitted_senders = ? WHERE source = ?", (forwards_to, permitted_senders, address))
 		return_status = "alias updated"
@@ -607,6 +914,7 @@ def remove_mail_alias(address, env, do_kick=True):
 	conn, c = open_database(env, with_connection=True)
 	c.execute("DELETE FROM aliases WHERE source=?", (address,))
 	if c.rowcount != 1:
+		conn.rollback()
 		return (f"That's not an alias ({address}).", 400)
 	conn.commit()
 
@@ -615,6 +923,75 @@ def remove_mail_alias(address, env, do_kick=True):
 		return kick(env, "alias removed")
 	return None
 
+def bulk_update_mail_aliases(rows, env):
+	# Adds, updates, and removes many aliases at once. Each row has an action
+	# ("add", the default, "update", or "remove"), an address, and for add and
+	# update forwards_to and permitted_senders. An add row with update_if_exists
+	# set to 1 updates the alias if it already exists, like /mail/aliases/add.
+	# As with users, everything is validated first, written in one transaction,
+	# and followed by a single kick().
+	if len(rows) == 0:
+		return "No aliases were given. No changes were made."
+	c = open_database(env)
+	c.execute("SELECT source FROM aliases")
+	existing_aliases = {row[0] for row in c.fetchall()}
+	valid_logins = get_mail_users(env)
+	seen = set()
+	changes = []
+	for i, row in enumerate(rows, start=1):
+		action = get_bulk_field(row, "action").strip().lower() or "add"
+		address = get_bulk_field(row, "address").strip()
+
+		if action == "remove":
+			address = sanitize_idn_email_address(address)
+			if address not in existing_aliases:
+				return bulk_error(i, address, f"That's not an alias ({address}).")
+			forwards_to = permitted_senders = None
+		elif action in {"add", "update"}:
+			try:
+				address, forwards_to, permitted_senders = validate_mail_alias(
+					address,
+					get_bulk_field(row, "forwards_to"),
+					get_bulk_field(row, "permitted_senders"),
+					env,
+					valid_logins=valid_logins)
+			except ValueError as e:
+				return bulk_error(i, address, str(e))
+			if action == "add" and address in existing_aliases:
+				if get_bulk_field(row, "update_if_exists").strip() != "1":
+					return bulk_error(i, address, f"Alias already exists ({address}).")
+				action = "update"
+			elif action == "update" and address not in existing_aliases:
+				return bulk_error(i, address, f"That's not an alias ({address}).")
+		else:
+			return bulk_error(i, address, f"Invalid action ({action}).")
+
+		if address in seen:
+			return bulk_error(i, address, "The address appears more than once.")
+		seen.add(address)
+
+		changes.append((action, address, forwards_to, permitted_senders))
+
+	# write everything to the database in one transaction
+	conn, c = open_database(env, with_connection=True)
+	try:
+		for action, address, forwards_to, permitted_senders in changes:
+			if action == "add":
+				c.execute("INSERT INTO aliases (source, destination, permitted_senders) VALUES (?, ?, ?)", (address, forwards_to, permitted_senders))
+			elif action == "update":
+				c.execute("UPDATE aliases SET destination = ?, permitted_senders = ? WHERE source = ?", (forwards_to, permitted_senders, address))
+			elif action == "remove":
+				c.execute("DELETE FROM aliases WHERE source=?", (address,))
+	except sqlite3.Error as e:
+		conn.rollback()
+		return (f"No changes were made because the database could not be updated: {e}", 500)
+	conn.commit()
+
+	counts = { action: sum(1 for change in changes if change[0] == action) for action in ("add", "update", "remove") }
+
+	# Update things in case any domains are added or removed.
+	return kick(env, f"{counts['add']} aliases added, {counts['update']} updated, {counts['remove']} removed")
+
 def add_auto_aliases(aliases, env):
 	conn, c = open_database(env, with_connection=True)
 	c.execute("DELETE FROM auto_aliases")
@@ -657,9 +1034,13 @@ def get_required_aliases(env):
 
 	return aliases
 
-def kick(env, mail_result=None):
+@utils.update_lock()
+def kick(env, mail_result=None, force=False):
 	results = []
 
+	# Look up users, aliases, domains, etc. once for everything below.
+	env = utils.config_snapshot(env)
+
 	# Include the current operation's result in output.
 
 	if mail_result is not None:
@@ -684,6 +1065,7 @@ def kick(env, mail_result=None):
 			continue
 
 	add_auto_aliases(auto_aliases, env)
+	utils.forget_memoized(env, "mail_aliases", "mail_domains")
 
 	# Remove auto-generated postmaster/admin/abuse alises from the main aliases table.
 	# They are now stored in the auto_aliases table.
@@ -694,18 +1076,98 @@ def kick(env, mail_result=None):
 			and forwards_to == get_system_administrator(env) \
 			and not auto:
 			remove_mail_alias(address, env, do_kick=False)
+			utils.forget_memoized(env, "mail_aliases", "mail_domains")
 			results.append(f"removed alias {address} (was to {forwards_to}; domain no longer used for email)\n")
 
-	# Update DNS and nginx in case any domains are added/removed.
+	# Update DNS and nginx in case any domains are added/removed. Rebuilding
+	# every zone and the whole nginx configuration is expensive, and most
+	# changes that get here (e.g. adding an alias on a domain that already
+	# has mail) change neither, so skip both if nothing they are built from
+	# has changed since the last time they were run from here. The daily
+	# DNS update and certificate provisioning don't go through kick, so
+	# DNSSEC re-signing and certificate renewals are not held up by this.
+	#
+	# The saved fingerprint is forgotten before the updates run and only saved
+	# again after a clean run. If a zone couldn't be signed (or either update
+	# raises an exception), the next kick runs both updates again even if
+	# nothing else changed.
+	fingerprint = get_kick_fingerprint(env)
+	if force or fingerprint != read_kick_fingerprint():
+		forget_kick_fingerprint()
 
-	from dns_update import do_dns_update
-	results.append( do_dns_update(env) )
+		from dns_update import do_dns_update_ex
+		dns_result, signing_errors = do_dns_update_ex(env)
+		results.append( dns_result )
 
-	from web_update import do_web_update
-	results.append( do_web_update(env) )
+		from web_update import do_web_update
+		results.append( do_web_update(env) )
+
+		if not signing_errors:
+			write_kick_fingerprint(fingerprint)
 
 	return "".join(s for s in results if s != "")
 
+KICK_FINGERPRINT_FILE = "/var/lib/mailinabox/kick-fingerprint.txt"
+
+def get_kick_fingerprint(env):
+	# Compute a digest of the inputs to do_dns_update and do_web_update other
+	# than the passage of time: the box's settings, the set of mail domains,
+	# and the files that hold custom DNS and web settings, certificates, and
+	# keys. Files are represented by their modification times and sizes so
+	# none of them need to be read.
+	import hashlib, json
+
+	def file_stamps(path, depth=0):
+		try:
+			st = os.stat(path)
+		except OSError:
+			return [[path]]
+		ret = [[path, st.st_mtime_ns, st.st_size]]
+		if depth > 0 and os.path.isdir(path):
+			for fn in sorted(os.listdir(path)):
+				ret.extend(file_stamps(os.path.join(path, fn), depth - 1))
+		return ret
+
+	files = []
+	files.extend(file_stamps(os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml')))
+	files.extend(file_stamps(os.path.join(env['STORAGE_ROOT'], 'dns/dnssec'), depth=1))
+	files.extend(file_stamps(os.path.join(env['STORAGE_ROOT'], 'mail/dkim/mail.txt')))
+	files.extend(file_stamps(os.path.join(env['STORAGE_ROOT'], 'www'), depth=1))
+	files.extend(file_stamps(os.path.join(env['STORAGE_ROOT'], 'ssl'), depth=2))
+	files.extend(file_stamps(os.path.realpath(os.path.join(env['STORAGE_ROOT'], 'ssl/ssl_certificate.pem'))))
+	files.extend(file_stamps("/var/lib/mailinabox/mta-sts.txt"))
+	files.extend(file_stamps(os.path.join(os.path.dirname(__file__), "../conf"), depth=1))
+
+	state = {
+		"env": env,
+		"mail_domains": sorted(get_mail_domains(env)),
+		"mail_user_domains": sorted(get_mail_domains(env, users_only=True)),
+		"files": files,
+	}
+	return hashlib.sha256(json.dumps(state, sort_keys=True).encode("utf8")).hexdigest()
+
+def read_kick_fingerprint():
+	try:
+		with open(KICK_FINGERPRINT_FILE, encoding="utf-8") as f:
+			return f.read().strip()
+	except OSError:
+		return None
+
+def write_kick_fingerprint(fingerprint):
+	try:
+		with open(KICK_FINGERPRINT_FILE, "w", encoding="utf-8") as f:
+			f.write(fingerprint + "\n")
+	except OSError:
+		# Not fatal. We'll just do the full update again next time.
+		pass
+
+def forget_kick_fingerprint():
+	try:
+		os.unlink(KICK_FINGERPRINT_FILE)
+	except OSError:
+		# Not fatal if it doesn't exist.
+		pass
+
 def validate_password(pw):
 	# validate password
 	if pw.strip() == "":
@@ -726,4 +1188,4 @@ if __name__ == "__main__":
 
 	if len(sys.argv) > 1 and sys.argv[1] == "update":
 		from utils import load_environment
-		print(kick(load_environment()))
+		print(kick(load_environment(), force=True))
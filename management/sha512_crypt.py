@@ -0,0 +1,112 @@
+# SHA512-CRYPT password hashes, which is the scheme we store user passwords
+# in (Dovecot's "{SHA512-CRYPT}$6$salt$hash" format). This is a plain Python
+# implementation of Ulrich Drepper's "Unix crypt using SHA-256 and SHA-512"
+# (https://www.akkadia.org/drepper/SHA-crypt.txt) so that the control panel
+# can hash and check passwords without starting a doveadm process each time.
+#
+# Only the standard library is used because, like mailconfig.py, this may
+# be imported by the system-wide Python 3.
+
+import hashlib, hmac, secrets
+
+SCHEME = "{SHA512-CRYPT}"
+
+ROUNDS_DEFAULT = 5000
+ROUNDS_MIN = 1000
+ROUNDS_MAX = 999999999
+SALT_MAX_LENGTH = 16
+
+ALPHABET = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# The order in which the bytes of the final digest are encoded, three at a time.
+ENCODING_ORDER = (
+	(0, 21, 42), (22, 43, 1), (44, 2, 23), (3, 24, 45), (25, 46, 4),
+	(47, 5, 26), (6, 27, 48), (28, 49, 7), (50, 8, 29), (9, 30, 51),
+	(31, 52, 10), (53, 11, 32), (12, 33, 54), (34, 55, 13), (56, 14, 35),
+	(15, 36, 57), (37, 58, 16), (59, 17, 38), (18, 39, 60), (40, 61, 19),
+	(62, 20, 41),
+)
+
+def sha512_crypt(password, salt, rounds=None):
+	# Returns the crypt(3) string "$6$[rounds=N$]salt$hash" for a password.
+	# rounds is only written into the string if it is given, as glibc does.
+	if isinstance(password, str):
+		password = password.encode("utf8")
+	salt = salt[:SALT_MAX_LENGTH]
+	salt_bytes = salt.encode("utf8")
+	n_rounds = ROUNDS_DEFAULT if rounds is None else min(max(rounds, ROUNDS_MIN), ROUNDS_MAX)
+
+	pw_len = len(password)
+
+	b = hashlib.sha512(password + salt_bytes + password).digest()
+
+	a = hashlib.sha512(password + salt_bytes)
+	a.update((b * (pw_len // 64 + 1))[:pw_len])
+	i = pw_len
+	while i > 0:
+		a.update(b if i & 1 else password)
+		i >>= 1
+	a = a.digest()
+
+	dp = hashlib.sha512(password * pw_len).digest()
+	p = (dp * (pw_len // 64 + 1))[:pw_len]
+
+	ds = hashlib.sha512(salt_bytes * (16 + a[0])).digest()
+	s = ds[:len(salt_bytes)]
+
+	# Each round hashes the previous digest with p and s around it in a
+	# pattern that repeats every 42 rounds, so work out the bytes that go
+	# before and after the digest once.
+	patterns = []
+	for r in range(42):
+		middle = (s if r % 3 else b"") + (p if r % 7 else b"")
+		if r & 1:
+			patterns.append((p + middle, b""))
+		else:
+			patterns.append((b"", middle + p))
+
+	c = a
+	sha512 = hashlib.sha512
+	for r in range(n_rounds):
+		before, after = patterns[r % 42]
+		c = sha512(before + c + after).digest()
+
+	encoded = []
+	for b2, b1, b0 in ENCODING_ORDER:
+		w = (c[b2] << 16) | (c[b1] << 8) | c[b0]
+		for _ in range(4):
+			encoded.append(ALPHABET[w & 0x3f])
+			w >>= 6
+	w = c[63]
+	for _ in range(2):
+		encoded.append(ALPHABET[w & 0x3f])
+		w >>= 6
+
+	rounds_str = "" if rounds is None else f"rounds={n_rounds}$"
+	return f"$6${rounds_str}{salt}${''.join(encoded)}"
+
+def hash_password(password):
+	# Returns a new Dovecot-format "{SHA512-CRYPT}..." hash with a random salt.
+	salt = "".join(secrets.choice(ALPHABET) for _ in range(SALT_MAX_LENGTH))
+	return SCHEME + sha512_crypt(password, salt)
+
+def verify_password(password, pw_hash):
+	# Checks a password against a Dovecot-format "{SHA512-CRYPT}..." hash.
+	# Returns True or False. Raises a ValueError if the hash isn't in that format.
+	if not pw_hash.startswith(SCHEME + "$6$"):
+		msg = "Not a SHA512-CRYPT password hash."
+		raise ValueError(msg)
+	fields = pw_hash[len(SCHEME):].split("$")
+	rounds = None
+	if len(fields) == 5 and fields[2].startswith("rounds="):
+		try:
+			rounds = int(fields[2][len("rounds="):])
+		except ValueError:
+			msg = "Invalid rounds in SHA512-CRYPT password hash."
+			raise ValueError(msg) from None
+		del fields[2]
+	if len(fields) != 4:
+		msg = "Invalid SHA512-CRYPT password hash."
+		raise ValueError(msg)
+	expected = SCHEME + sha512_crypt(password, fields[2], rounds)
+	return hmac.compare_digest(expected.encode("utf8"), pw_hash.encode("utf8"))
@@ -3,7 +3,7 @@
 
 import os, os.path, re, shutil, subprocess, tempfile
 
-from utils import shell, safe_domain_name, sort_domains
+from utils import shell, safe_domain_name, sort_domains, DomainSuffixIndex, memoized, forget_memoized, config_snapshot, update_lock
 import functools
 import operator
 
@@ -13,7 +13,9 @@ def get_ssl_certificates(env):
 	# Scan all of the installed SSL certificates and map every domain
 	# that the certificates are good for to the best certificate for
 	# the domain.
+	return dict(memoized(env, "ssl_certificates", lambda: scan_ssl_certificates(env)))
 
+def scan_ssl_certificates(env):
 	from cryptography.hazmat.primitives.asymmetric import dsa, rsa, ec
 	from cryptography.x509 import Certificate
 
@@ -181,6 +183,7 @@ def get_certificates_to_provision(env, limit_domains=None, show_valid_certs=True
 	from web_update import get_web_domains
 	from status_checks import query_dns, normalize_ip
 
+	env = config_snapshot(env)
 	existing_certs = get_ssl_certificates(env)
 
 	plausible_web_domains = get_web_domains(env, exclude_dns_elsewhere=False)
@@ -237,7 +240,10 @@ def get_certificates_to_provision(env, limit_domains=None, show_valid_certs=True
 
 	return (domains_to_provision, domains_cant_provision)
 
+@update_lock()
 def provision_certificates(env, limit_domains):
+	env = config_snapshot(env)
+
 	# What domains should we provision certificates for? And what
 	# errors prevent provisioning for other domains.
 	domains, domains_cant_provision = get_certificates_to_provision(env, limit_domains=limit_domains)
@@ -263,24 +269,26 @@ def provision_certificates(env, limit_domains):
 	# primary domain listed in each certificate.
 	from dns_update import get_dns_zones
 	certs = { }
+	parents = DomainSuffixIndex()
 	for zone, _zonefile in get_dns_zones(env):
 		certs[zone] = [[]]
+		parents.add(zone)
 	for domain in sort_domains(domains, env):
-		# Does the domain end with any domain we've seen so far.
-		for parent in certs:
-			if domain.endswith("." + parent):
-				# Add this to the parent's list of domains.
-				# Start a new group if the list already has
-				# 100 items.
-				if len(certs[parent][-1]) == 100:
-					certs[parent].append([])
-				certs[parent][-1].append(domain)
-				break
+		# Is the domain, or a domain it is a subdomain of, one we've seen so far?
+		parent = parents.find(domain)
+		if parent is not None:
+			# Add this to the parent's list of domains.
+			# Start a new group if the list already has
+			# 100 items.
+			if len(certs[parent][-1]) == 100:
+				certs[parent].append([])
+			certs[parent][-1].append(domain)
 		else:
 			# This domain is not a child of any domain we've seen yet, so
 			# start a new group. This shouldn't happen since every zone
 			# was already added.
 			certs[domain] = [[domain]]
+			parents.add(domain)
 
 	# Flatten to a list of lists of domains (from a mapping). Remove empty
 	# lists (zones with no domains that need certs).
@@ -459,6 +467,7 @@ def install_cert_copy_file(fn, env):
 	# Install the certificate.
 	os.makedirs(os.path.dirname(ssl_certificate), exist_ok=True)
 	shutil.move(fn, ssl_certificate)
+	forget_memoized(env, "ssl_certificates")
 
 
 def post_install_func(env):
@@ -4,21 +4,21 @@
 # TLS certificates have been signed, etc., and if not tells the user
 # what to do next.
 
-import sys, os, os.path, re, datetime, multiprocessing.pool
+import sys, os, os.path, re, datetime, time, multiprocessing.pool, threading, contextlib
 import asyncio
 import dateutil.parser, dateutil.relativedelta, dateutil.tz
 
-import dns.reversename, dns.resolver
+import dns.reversename, dns.resolver, dns.asyncresolver
 import idna
 import psutil
 import postfix_mta_sts_resolver.resolver
 
-from dns_update import get_dns_zones, build_tlsa_record, get_custom_dns_config, get_secondary_dns, get_custom_dns_records
+from dns_update import get_dns_zones, build_tlsa_record, get_custom_dns_config, get_secondary_dns, get_custom_dns_records, get_cached_ds_records, get_files_stat
 from web_update import get_web_domains, get_domains_with_a_records
 from ssl_certificates import get_ssl_certificates, get_domain_ssl_files, check_certificate
 from mailconfig import get_mail_domains, get_mail_aliases
 
-from utils import shell, sort_domains, load_env_vars_from_file, load_settings, get_ssh_port, get_ssh_config_value
+from utils import shell, sort_domains, load_env_vars_from_file, load_settings, get_ssh_port, get_ssh_config_value, config_snapshot, write_file_atomic, DomainSuffixIndex
 from backup import get_backup_config, backup_status
 
 def get_services():
@@ -44,7 +44,10 @@ def get_services():
 		{ "name": "HTTPS Web (nginx)", "port": 443, "public": True, },
 	]
 
-def run_checks(rounded_values, env, output, pool, domains_to_check=None):
+def run_checks(rounded_values, env, output, pool, domains_to_check=None, verbose=False, incremental=False, force=False):
+	# Look up users, aliases, domains, etc. once for all of the checks.
+	env = config_snapshot(env)
+
 	# run systems checks
 	output.add_heading("System")
 
@@ -65,7 +68,7 @@ def run_checks(rounded_values, env, output, pool, domains_to_check=None):
 	# perform other checks asynchronously
 
 	run_network_checks(env, output)
-	run_domain_checks(rounded_values, env, output, pool, domains_to_check=domains_to_check)
+	run_domain_checks(rounded_values, env, output, pool, domains_to_check=domains_to_check, verbose=verbose, incremental=incremental, force=force)
 
 def run_services_checks(env, output, pool):
 	# Check that system services are running.
@@ -356,7 +359,19 @@ def evaluate_spamhaus_lookup(lookupaddress, lookuptype, lookupdomain, output, ze
 		 	http://www.spamhaus.org/query/ip/{lookupaddress}.""")
 
 
-def run_domain_checks(rounded_time, env, output, pool, domains_to_check=None):
+# The results of the checks for each domain are saved here, with a hash of
+# what the checks depend on, so that an incremental run can reuse them.
+DOMAIN_CHECKS_CACHE_FN = "/var/cache/mailinabox/status_checks_domains.json"
+
+# Results are reused for at most this long, in case a check depends on
+# something that isn't in the hash.
+DOMAIN_CHECKS_MAX_AGE = 60*60*24*3
+
+def run_domain_checks(rounded_time, env, output, pool, domains_to_check=None, verbose=False, incremental=False, force=False):
+	# Run the checks for each domain. If incremental is set, the saved results
+	# for a domain are used instead if nothing they depend on has changed,
+	# unless force is set. The results of the checks run are saved either way.
+
 	# Get the list of domains we handle mail for.
 	mail_domains = get_mail_domains(env)
 
@@ -384,74 +399,277 @@ def run_domain_checks(rounded_time, env, output, pool, domains_to_check=None):
 	# Get the list of domains that we don't serve web for because of a custom CNAME/A record.
 	domains_with_a_records = get_domains_with_a_records(env)
 
+	# Load the certificates once for all of the workers, if they are threads.
+	get_ssl_certificates(env)
+
+	# Make the DNS queries that the checks will make for all of the domains
+	# up front and all at once, so that each query is made once rather than
+	# once per domain or worker. The custom secondary nameservers are checked
+	# for every zone, by asking them directly once we have their addresses.
+	dns_cache = DNSAnswerCache()
+	secondary_ns = get_secondary_dns(get_custom_dns_config(env), mode="NS")
+	domain_queries = { }
+	for domain in domains_to_check:
+		domain_queries[domain] = get_domain_dns_queries(domain, env, dns_domains, mail_domains, web_domains)
+		if domain in dns_domains:
+			domain_queries[domain] |= {(ns, "A") for ns in secondary_ns}
+	dns_cache.prefetch(set().union(*domain_queries.values()))
+	with use_dns_answer_cache(dns_cache):
+		secondary_ns_ips = [query_dns(ns, "A").split('; ')[0] for ns in secondary_ns]
+	secondary_ns_ips = [ns_ip for ns_ip in secondary_ns_ips if ns_ip not in {'', '[Not Set]', '[timeout]'}]
+	for domain in domains_to_check:
+		if domain in dns_domains and secondary_ns_ips:
+			domain_queries[domain].add((domain, "SOA", env['PUBLIC_IP']))
+			for ns_ip in secondary_ns_ips:
+				domain_queries[domain] |= {(domain, "A", ns_ip), (domain, "SOA", ns_ip)}
+	queries = set().union(*domain_queries.values())
+	dns_cache.prefetch(queries)
+
+	# Reuse the saved results for domains whose checks depend on the same
+	# things as when they were saved. Results are saved separately for
+	# rounded and exact output.
+	domain_checks_cache = load_domain_checks_cache()
+	saved_results = domain_checks_cache.setdefault("rounded" if rounded_time else "exact", { })
+	fingerprint_inputs = get_domain_checks_fingerprint_inputs(env, dns_zonefiles)
+	fingerprints = { }
+	ret = { }
+	for domain in domains_to_check:
+		fingerprints[domain] = get_domain_checks_fingerprint(domain, domain_queries[domain], rounded_time, env, dns_domains, mail_domains, web_domains, domains_with_a_records, dns_cache, fingerprint_inputs)
+		saved = saved_results.get(domain)
+		if incremental and not force and saved and fingerprints[domain][0] is not None \
+		  and saved["fingerprint"] == fingerprints[domain][0] and saved["expires"] > time.time():
+			ret[domain] = BufferedOutput(with_lines=saved["output"])
+	reused = len(ret)
+
 	# Serial version:
 	#for domain in sort_domains(domains_to_check, env):
 	#	run_domain_checks_on_domain(domain, rounded_time, env, dns_domains, dns_zonefiles, mail_domains, web_domains)
 
-	# Parallelize the checks across a worker pool.
-	args = ((domain, rounded_time, env, dns_domains, dns_zonefiles, mail_domains, web_domains, domains_with_a_records)
-		for domain in domains_to_check)
-	ret = pool.starmap(run_domain_checks_on_domain, args, chunksize=1)
-	ret = dict(ret) # (domain, output) => { domain: output }
+	# Parallelize the checks across a worker pool. Each domain's checks are
+	# given only the answers to their own queries, since in a process pool
+	# they're pickled for each task.
+	args = ((domain, rounded_time, env, dns_domains, dns_zonefiles, mail_domains, web_domains, domains_with_a_records, dns_cache.subset(domain_queries[domain]))
+		for domain in domains_to_check if domain not in ret)
+	results = pool.starmap(run_domain_checks_on_domain, args, chunksize=1)
+	hits = sum(dns_hits for _domain, _output, (dns_hits, _dns_misses) in results)
+	misses = sum(dns_misses for _domain, _output, (_dns_hits, dns_misses) in results)
+	for domain, domain_output, _dns_stats in results:
+		ret[domain] = domain_output
+		fingerprint, expires = fingerprints[domain]
+		if fingerprint is None:
+			saved_results.pop(domain, None)
+		else:
+			saved_results[domain] = { "fingerprint": fingerprint, "expires": expires, "output": domain_output.buf }
 	for domain in sort_domains(ret, env):
 		ret[domain].playback(output)
 
-def run_domain_checks_on_domain(domain, rounded_time, env, dns_domains, dns_zonefiles, mail_domains, web_domains, domains_with_a_records):
-	output = BufferedOutput()
+	# Save the results, forgetting domains that we no longer have.
+	all_domains = mail_domains | dns_domains | web_domains
+	for results_by_domain in domain_checks_cache.values():
+		for domain in list(results_by_domain):
+			if domain not in all_domains:
+				del results_by_domain[domain]
+	save_domain_checks_cache(domain_checks_cache)
 
-	# When running inside Flask, the worker threads don't get a thread pool automatically.
-	# Also this method is called in a forked worker pool, so creating a new loop is probably
-	# a good idea.
-	asyncio.set_event_loop(asyncio.new_event_loop())
+	if verbose:
+		print(f"DNS answer cache: {len(queries)} queries prefetched, {hits} hits, {misses} misses.", file=sys.stderr)
+		print(f"Domain checks: {len(results)} domains checked, {reused} unchanged domains' results reused.", file=sys.stderr)
+
+def load_domain_checks_cache():
+	import json
+	try:
+		with open(DOMAIN_CHECKS_CACHE_FN, encoding="utf-8") as f:
+			cache = json.load(f)
+		if not isinstance(cache, dict): raise ValueError # caught below
+		return cache
+	except (OSError, ValueError):
+		return { }
+
+def save_domain_checks_cache(cache):
+	import json
+	os.makedirs(os.path.dirname(DOMAIN_CHECKS_CACHE_FN), exist_ok=True)
+	write_file_atomic(DOMAIN_CHECKS_CACHE_FN, json.dumps(cache, sort_keys=True))
+
+def get_domain_checks_fingerprint_inputs(env, dns_zonefiles):
+	# Things that the checks for any domain depend on, looked up once for all
+	# of the domains.
+	custom_dns_records = get_custom_dns_config(env)
+	aliases_by_domain = { }
+	for alias in get_mail_aliases(env):
+		aliases_by_domain.setdefault(alias[0].split("@", 1)[-1], []).append(alias)
+	return {
+		"custom_dns_records": custom_dns_records,
+		"aliases_by_domain": aliases_by_domain,
+		"zones": DomainSuffixIndex(dns_zonefiles),
+		"ds_records": {
+			zone: [get_files_stat(['/etc/nsd/zones/' + zonefile + '.ds']), get_cached_ds_records(zone)]
+			for zone, zonefile in dns_zonefiles.items()
+		},
+		"common": {
+			"status_checks": get_files_stat([__file__]),
+			"env": sorted(env.items()),
+		},
+	}
+
+def get_domain_checks_fingerprint(domain, queries, rounded_time, env, dns_domains, mail_domains, web_domains, domains_with_a_records, dns_cache, fingerprint_inputs):
+	# Returns a hash of what the checks for the domain (and its www, autoconfig
+	# and autodiscover subdomains) depend on, and the time until which results
+	# with the same hash can be reused. queries are the domain's queries that
+	# run_domain_checks prefetched into dns_cache. The hash is None if the
+	# results can't be reused because one of them didn't get an answer.
+	import hashlib, json
+	now = time.time()
+	expires = now + DOMAIN_CHECKS_MAX_AGE
+
+	# The answers to the DNS queries that the checks make, including those
+	# made directly to the secondary nameservers, and the MTA-STS policies.
+	answers = []
+	for query in queries:
+		qname, rtype, at = get_dns_query_key(*query)
+		try:
+			answer = dns_cache.get((qname, rtype, at))
+		except KeyError:
+			return (None, None)
+		if answer == "[timeout]":
+			return (None, None)
+		answers.append((qname, rtype, at or "", sorted(str(r) for r in answer) if answer is not None else None))
+
+	inputs = {
+		"common": fingerprint_inputs["common"],
+		"rounded_time": rounded_time,
+		"answers": sorted(answers),
+		"domains": [],
+	}
 
-	# we'd move this up, but this returns non-pickleable values
 	ssl_certificates = get_ssl_certificates(env)
+	for d in [domain] + [label + "." + domain for label in ("www", "autoconfig", "autodiscover")]:
+		if d != domain and d not in web_domains and d not in mail_domains:
+			continue
+		d_inputs = {
+			"domain": d,
+			"dns": d in dns_domains,
+			"mail": d in mail_domains,
+			"web": d in web_domains,
+			"custom_a_records": [d in domains_with_a_records, "www." + d in domains_with_a_records],
+			"custom_a": sorted(get_custom_dns_records(fingerprint_inputs["custom_dns_records"], d, "A")),
+			"aliases": fingerprint_inputs["aliases_by_domain"].get(d, []),
+			"zone_ds_records": fingerprint_inputs["ds_records"].get(fingerprint_inputs["zones"].find(d)),
+		}
+
+		# The certificate check says how many days are left before the
+		# certificate expires, in exact output, or once it's about to expire.
+		tls_cert = get_domain_ssl_files(d, ssl_certificates, env, allow_missing_cert=True) if d in web_domains or d == env['PRIMARY_HOSTNAME'] else None
+		if tls_cert is not None:
+			d_inputs["certificate"] = get_files_stat([tls_cert["certificate"], tls_cert["private-key"]])
+			seconds_left = (tls_cert["certificate_object"].not_valid_after - datetime.datetime.utcnow()).total_seconds()
+			if rounded_time:
+				expires = min(expires, now + seconds_left - 60*60*24*11)
+			else:
+				expires = min(expires, now + seconds_left % (60*60*24))
 
-	# The domain is IDNA-encoded in the database, but for display use Unicode.
-	try:
-		domain_display = idna.decode(domain.encode('ascii'))
-		output.add_heading(domain_display)
-	except (ValueError, UnicodeError, idna.IDNAError) as e:
-		# Looks like we have some invalid data in our database.
-		output.add_heading(domain)
-		output.print_error("Domain name is invalid: " + str(e))
+		inputs["domains"].append(d_inputs)
 
-	if domain == env["PRIMARY_HOSTNAME"]:
-		check_primary_hostname_dns(domain, env, output, dns_domains, dns_zonefiles)
+	fingerprint = hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode("utf8")).hexdigest()
+	return (fingerprint, expires)
 
-	if domain in dns_domains:
-		check_dns_zone(domain, env, output, dns_zonefiles)
+_worker_event_loop = threading.local()
 
-	if domain in mail_domains:
-		check_mail_domain(domain, env, output)
+def run_domain_checks_on_domain(domain, rounded_time, env, dns_domains, dns_zonefiles, mail_domains, web_domains, domains_with_a_records, dns_cache=None):
+	# Returns (domain, output, (DNS answer cache hits, misses)).
+	output = BufferedOutput()
 
-	if domain in web_domains:
-		check_web_domain(domain, rounded_time, ssl_certificates, env, output)
+	# When running inside Flask, the worker threads don't get an event loop automatically.
+	# Also this method is called in a forked worker pool, so give each worker thread or
+	# process a loop of its own. The daemon's worker threads are reused for later status
+	# checks, so they keep theirs rather than making a new one each time.
+	if getattr(_worker_event_loop, "loop", None) is None:
+		_worker_event_loop.loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(_worker_event_loop.loop)
+
+	# This returns non-pickleable values, so in a process pool it is loaded
+	# again in each worker. A thread pool shares the one run_domain_checks
+	# loaded through env, which is a configuration snapshot.
+	ssl_certificates = get_ssl_certificates(env)
 
-	if domain in dns_domains:
-		check_dns_zone_suggestions(domain, env, output, dns_zonefiles, domains_with_a_records)
+	# Make the DNS queries for the checks below that don't depend on each other
+	# all at once rather than one after another, if run_domain_checks hasn't.
+	if dns_cache is None:
+		dns_cache = DNSAnswerCache()
+	dns_cache.prefetch(get_domain_dns_queries(domain, env, dns_domains, mail_domains, web_domains))
 
-	# Check auto-configured subdomains. See run_domain_checks.
-	# Skip mta-sts because we check the policy directly.
+	with use_dns_answer_cache(dns_cache):
+		# The domain is IDNA-encoded in the database, but for display use Unicode.
+		try:
+			domain_display = idna.decode(domain.encode('ascii'))
+			output.add_heading(domain_display)
+		except (ValueError, UnicodeError, idna.IDNAError) as e:
+			# Looks like we have some invalid data in our database.
+			output.add_heading(domain)
+			output.print_error("Domain name is invalid: " + str(e))
+
+		if domain == env["PRIMARY_HOSTNAME"]:
+			check_primary_hostname_dns(domain, env, output, dns_domains, dns_zonefiles)
+
+		if domain in dns_domains:
+			check_dns_zone(domain, env, output, dns_zonefiles)
+
+		if domain in mail_domains:
+			check_mail_domain(domain, env, output)
+
+		if domain in web_domains:
+			check_web_domain(domain, rounded_time, ssl_certificates, env, output)
+
+		if domain in dns_domains:
+			check_dns_zone_suggestions(domain, env, output, dns_zonefiles, domains_with_a_records)
+
+		# Check auto-configured subdomains. See run_domain_checks.
+		# Skip mta-sts because we check the policy directly.
+		for label in ("www", "autoconfig", "autodiscover"):
+			subdomain = label + "." + domain
+			if subdomain in web_domains or subdomain in mail_domains:
+				# Run checks.
+				subdomain_output = run_domain_checks_on_domain(subdomain, rounded_time, env, dns_domains, dns_zonefiles, mail_domains, web_domains, domains_with_a_records, dns_cache)
+
+				# Prepend the domain name to the start of each check line, and then add to the
+				# checks for this domain.
+				for attr, args, kwargs in subdomain_output[1].buf:
+					if attr == "add_heading":
+						# Drop the heading, but use its text as the subdomain name in
+						# each line since it is in Unicode form.
+						subdomain = args[0]
+						continue
+					if len(args) == 1 and isinstance(args[0], str):
+						args = [ subdomain + ": " + args[0] ]
+					getattr(output, attr)(*args, **kwargs)
+
+	return (domain, output, (dns_cache.hits, dns_cache.misses))
+
+def get_domain_dns_queries(domain, env, dns_domains, mail_domains, web_domains):
+	# Returns the (qname, rtype) queries that the checks for the domain (and
+	# its www, autoconfig and autodiscover subdomains) will make whatever the
+	# answers to other queries are, plus each mail domain's MTA-STS policy,
+	# which is checked if the domain's MX record points here.
+	queries = set()
+	if domain == env["PRIMARY_HOSTNAME"]:
+		queries |= {(zone, "DS") for zone in dns_domains if zone == domain or domain.endswith("." + zone)}
+		queries |= {(domain, "A"), ("ns1." + domain, "A"), ("ns2." + domain, "A"), ("_25._tcp." + domain, "TLSA")}
+		queries.add((dns.reversename.from_address(env['PUBLIC_IP']), "PTR"))
+		if env.get("PUBLIC_IPV6"):
+			queries.add((domain, "AAAA"))
+			queries.add((dns.reversename.from_address(env['PUBLIC_IPV6']), "PTR"))
+	if domain in dns_domains:
+		queries |= {(domain, "DS"), (domain, "NS"), (domain, "A")}
+	if domain in mail_domains:
+		queries |= {(domain, "MX"), (domain, "A"), (env['PRIMARY_HOSTNAME'], "A"), (domain + ".dbl.spamhaus.org", "A"), (domain, "MTA-STS")}
+	if domain in web_domains:
+		queries.add((domain, "A"))
+		if env.get("PUBLIC_IPV6"):
+			queries.add((domain, "AAAA"))
 	for label in ("www", "autoconfig", "autodiscover"):
 		subdomain = label + "." + domain
 		if subdomain in web_domains or subdomain in mail_domains:
-			# Run checks.
-			subdomain_output = run_domain_checks_on_domain(subdomain, rounded_time, env, dns_domains, dns_zonefiles, mail_domains, web_domains, domains_with_a_records)
-
-			# Prepend the domain name to the start of each check line, and then add to the
-			# checks for this domain.
-			for attr, args, kwargs in subdomain_output[1].buf:
-				if attr == "add_heading":
-					# Drop the heading, but use its text as the subdomain name in
-					# each line since it is in Unicode form.
-					subdomain = args[0]
-					continue
-				if len(args) == 1 and isinstance(args[0], str):
-					args = [ subdomain + ": " + args[0] ]
-				getattr(output, attr)(*args, **kwargs)
-
-	return (domain, output)
+			queries |= get_domain_dns_queries(subdomain, env, dns_domains, mail_domains, web_domains)
+	return queries
 
 def check_primary_hostname_dns(domain, env, output, dns_domains, dns_zonefiles):
 	# If a DS record is set on the zone containing this domain, check DNSSEC now.
@@ -549,7 +767,7 @@ def check_dns_zone(domain, env, output, dns_zonefiles):
 	# this query being answered by the box, which would mean the test is only
 	# half working.)
 
-	custom_dns_records = list(get_custom_dns_config(env)) # generator => list so we can reuse it
+	custom_dns_records = get_custom_dns_config(env)
 	correct_ip = "; ".join(sorted(get_custom_dns_records(custom_dns_records, domain, "A"))) or env['PUBLIC_IP']
 	custom_secondary_ns = get_secondary_dns(custom_dns_records, mode="NS")
 	secondary_ns = custom_secondary_ns or ["ns2." + env['PRIMARY_HOSTNAME']]
@@ -642,32 +860,43 @@ def check_dnssec(domain, env, output, dns_zonefiles, is_checking_primary=False):
 	alg_name_map = { '7': 'RSASHA1-NSEC3-SHA1', '8': 'RSASHA256', '13': 'ECDSAP256SHA256' }
 	digalg_name_map = { '1': 'SHA-1', '2': 'SHA-256', '4': 'SHA-384' }
 
-	# Read in the pre-generated DS records
+	# Read in the pre-generated DS records, along with the public keys they are for,
+	# from the cache written when the zone was signed. Fall back to the .ds file
+	# written next to the zone file.
+	ds_records = [
+		(rr_ds, entry["pubkey"])
+		for entry in get_cached_ds_records(domain).values()
+		for rr_ds in entry["ds"]
+	]
+	if not ds_records:
+		ds_file = '/etc/nsd/zones/' + dns_zonefiles[domain] + '.ds'
+		if not os.path.exists(ds_file): return # Domain is in our database but DNS has not yet been updated.
+		with open(ds_file, encoding="utf-8") as f:
+			ds_records = [(rr_ds, None) for rr_ds in f]
+
 	expected_ds_records = { }
-	ds_file = '/etc/nsd/zones/' + dns_zonefiles[domain] + '.ds'
-	if not os.path.exists(ds_file): return # Domain is in our database but DNS has not yet been updated.
-	with open(ds_file, encoding="utf-8") as f:
-		for rr_ds in f:
-			rr_ds = rr_ds.rstrip()
-			ds_keytag, ds_alg, ds_digalg, ds_digest = rr_ds.split("\t")[4].split(" ")
-
-			# Some registrars may want the public key so they can compute the digest. The DS
-			# record that we suggest using is for the KSK (and that's how the DS records were generated).
-			# We'll also give the nice name for the key algorithm.
+	for rr_ds, dnsssec_pubkey in ds_records:
+		rr_ds = rr_ds.rstrip()
+		ds_keytag, ds_alg, ds_digalg, ds_digest = rr_ds.split("\t")[4].split(" ")
+
+		# Some registrars may want the public key so they can compute the digest. The DS
+		# record that we suggest using is for the KSK (and that's how the DS records were generated).
+		# We'll also give the nice name for the key algorithm.
+		if dnsssec_pubkey is None:
 			dnssec_keys = load_env_vars_from_file(os.path.join(env['STORAGE_ROOT'], f'dns/dnssec/{alg_name_map[ds_alg]}.conf'))
 			with open(os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/' + dnssec_keys['KSK'] + '.key'), encoding="utf-8") as f:
 				dnsssec_pubkey = f.read().split("\t")[3].split(" ")[3]
 
-			expected_ds_records[ ds_keytag, ds_alg, ds_digalg, ds_digest ] = {
-				"record": rr_ds,
-				"keytag": ds_keytag,
-				"alg": ds_alg,
-				"alg_name": alg_name_map[ds_alg],
-				"digalg": ds_digalg,
-				"digalg_name": digalg_name_map[ds_digalg],
-				"digest": ds_digest,
-				"pubkey": dnsssec_pubkey,
-			}
+		expected_ds_records[ ds_keytag, ds_alg, ds_digalg, ds_digest ] = {
+			"record": rr_ds,
+			"keytag": ds_keytag,
+			"alg": ds_alg,
+			"alg_name": alg_name_map[ds_alg],
+			"digalg": ds_digalg,
+			"digalg_name": digalg_name_map[ds_digalg],
+			"digest": ds_digest,
+			"pubkey": dnsssec_pubkey,
+		}
 
 	# Query public DNS for the DS record at the registrar.
 	ds = query_dns(domain, "DS", nxdomain=None, as_list=True)
@@ -777,9 +1006,7 @@ def check_mail_domain(domain, env, output):
 		output.print_ok(good_news)
 
 		# Check MTA-STS policy.
-		loop = asyncio.new_event_loop()
-		sts_resolver = postfix_mta_sts_resolver.resolver.STSResolver(loop=loop)
-		valid, policy = loop.run_until_complete(sts_resolver.resolve(domain))
+		valid, policy = query_mta_sts_policy(domain)
 		if valid == postfix_mta_sts_resolver.resolver.STSFetchResult.VALID:
 			if policy[1].get("mx") == [env['PRIMARY_HOSTNAME']] and policy[1].get("mode") == "enforce": # policy[0] is the policyid
 				output.print_ok("MTA-STS policy is present.")
@@ -848,7 +1075,77 @@ def check_web_domain(domain, rounded_time, ssl_certificates, env, output):
 	# website for also needs a signed certificate.
 	check_ssl_cert(domain, rounded_time, ssl_certificates, env, output)
 
-def query_dns(qname, rtype, nxdomain='[Not Set]', at=None, as_list=False):
+# How long to remember that a query had no answer or timed out. Answers
+# are remembered for as long as their TTL.
+DNS_NEGATIVE_ANSWER_TTL = 60
+
+# How long to remember a domain's MTA-STS policy, fetched or not.
+MTA_STS_POLICY_TTL = 60
+
+class DNSAnswerCache:
+	# Answers to DNS queries keyed by (qname, rtype, nameserver), each with
+	# the time at which it expires. Each answer is a list of records, None if
+	# there is no answer, or "[timeout]". A domain's MTA-STS policy is kept
+	# here too with the rtype "MTA-STS", as the [result, policy] that
+	# query_mta_sts_policy returns. The status checks collect answers
+	# to the queries for all of the domains in the parent process and give
+	# the checks for each domain a cache of their own with just the answers
+	# to that domain's queries, where query_dns uses it while it's activated
+	# with use_dns_answer_cache. The domain's cache is all that's sent to a
+	# worker process, and it counts the domain's own hits and misses.
+
+	def __init__(self):
+		self.answers = { }
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		# Returns the answer, or raises KeyError if there isn't an unexpired one.
+		expires, answer = self.answers[key]
+		if expires < time.time():
+			raise KeyError(key)
+		return answer
+
+	def add(self, key, answer, ttl):
+		self.answers[key] = (time.time() + ttl, answer)
+
+	def prefetch(self, queries):
+		# Resolve the (qname, rtype) or (qname, rtype, nameserver) queries
+		# that don't have an answer yet, all at once.
+		keys = set()
+		for query in queries:
+			key = get_dns_query_key(*query)
+			try:
+				self.get(key)
+			except KeyError:
+				keys.add(key)
+		for key, (answer, ttl) in resolve_dns_queries_concurrently(keys).items():
+			self.add(key, answer, ttl)
+
+	def subset(self, queries):
+		# Returns a new cache with the answers to just these queries, so they
+		# expire when they would have in this one.
+		cache = DNSAnswerCache()
+		for query in queries:
+			key = get_dns_query_key(*query)
+			if key in self.answers:
+				cache.answers[key] = self.answers[key]
+		return cache
+
+_dns_answers = threading.local()
+
+@contextlib.contextmanager
+def use_dns_answer_cache(cache):
+	# Have query_dns use the answers in the cache, and add the answers to the
+	# other queries it makes, until the end of the with block.
+	parent = getattr(_dns_answers, "cache", None)
+	_dns_answers.cache = cache
+	try:
+		yield cache
+	finally:
+		_dns_answers.cache = parent
+
+def get_dns_query_key(qname, rtype, at=None):
 	# Make the qname absolute by appending a period. Without this, dns.resolver.query
 	# will fall back a failed lookup to a second query with this machine's hostname
 	# appended. This has been causing some false-positive Spamhaus reports. The
@@ -856,6 +1153,58 @@ def query_dns(qname, rtype, nxdomain='[Not Set]', at=None, as_list=False):
 	# absolute so we should not modify that.
 	if isinstance(qname, str):
 		qname += "."
+	return (str(qname), rtype, at)
+
+def resolve_dns_queries_concurrently(keys, max_concurrent_queries=50):
+	# Resolve (qname, rtype, at) queries at the same time (up to
+	# max_concurrent_queries at once) using an event loop, like
+	# resolve_dns_query and query_mta_sts_policy would one at a time.
+	# Returns a dict of (answer, ttl) like resolve_dns_query returns. Queries
+	# that fail in an unexpected way are left out so that query_dns tries them
+	# again and reports the error in the usual way.
+	keys = list(keys)
+	if len(keys) == 0:
+		return { }
+
+	resolvers = { }
+	def get_resolver(at):
+		if at not in resolvers:
+			if at is None:
+				resolvers[at] = dns.asyncresolver.Resolver()
+			else:
+				resolvers[at] = dns.asyncresolver.Resolver(configure=False)
+				resolvers[at].nameservers = [at]
+			resolvers[at].timeout = 5
+			resolvers[at].lifetime = 5
+		return resolvers[at]
+
+	async def resolve(qname, rtype, at, semaphore):
+		async with semaphore:
+			if rtype == "MTA-STS":
+				sts_resolver = postfix_mta_sts_resolver.resolver.STSResolver(loop=asyncio.get_running_loop())
+				return (list(await sts_resolver.resolve(qname)), MTA_STS_POLICY_TTL)
+			try:
+				response = await get_resolver(at).resolve(qname, rtype)
+				return (list(response), response.rrset.ttl)
+			except (dns.resolver.NoNameservers, dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+				return (None, DNS_NEGATIVE_ANSWER_TTL)
+			except dns.exception.Timeout:
+				return ("[timeout]", DNS_NEGATIVE_ANSWER_TTL)
+
+	async def resolve_all():
+		semaphore = asyncio.Semaphore(max_concurrent_queries)
+		return await asyncio.gather(*(resolve(qname, rtype, at, semaphore) for qname, rtype, at in keys), return_exceptions=True)
+
+	loop = asyncio.new_event_loop()
+	try:
+		results = loop.run_until_complete(resolve_all())
+	finally:
+		loop.close()
+	return { key: result for key, result in zip(keys, results) if not isinstance(result, BaseException) }
+
+def resolve_dns_query(qname, rtype, at):
+	# Returns the records in the answer to a query, None if there is no
+	# answer, or "[timeout]", and the number of seconds to remember it for.
 
 	# Use the default nameservers (as defined by the system, which is our locally
 	# running bind server), or if the 'at' argument is specified, use that host
@@ -876,12 +1225,32 @@ def query_dns(qname, rtype, nxdomain='[Not Set]', at=None, as_list=False):
 	# Do the query.
 	try:
 		response = resolver.resolve(qname, rtype)
+		return (list(response), response.rrset.ttl)
 	except (dns.resolver.NoNameservers, dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
 		# Host did not have an answer for this query; not sure what the
 		# difference is between the two exceptions.
-		return nxdomain
+		return (None, DNS_NEGATIVE_ANSWER_TTL)
 	except dns.exception.Timeout:
-		return "[timeout]"
+		return ("[timeout]", DNS_NEGATIVE_ANSWER_TTL)
+
+def query_dns(qname, rtype, nxdomain='[Not Set]', at=None, as_list=False):
+	# Use the answer in the DNS answer cache if there is one.
+	key = get_dns_query_key(qname, rtype, at)
+	cache = getattr(_dns_answers, "cache", None)
+	try:
+		if cache is None: raise KeyError # make the query below
+		response = cache.get(key)
+		cache.hits += 1
+	except KeyError:
+		response, ttl = resolve_dns_query(key[0], rtype, at)
+		if cache is not None:
+			cache.misses += 1
+			cache.add(key, response, ttl)
+
+	if response is None:
+		return nxdomain
+	if response == "[timeout]":
+		return response
 
 	# Normalize IP addresses. IP address --- especially IPv6 addresses --- can
 	# be expressed in equivalent string forms. Canonicalize the form before
@@ -899,6 +1268,27 @@ def query_dns(qname, rtype, nxdomain='[Not Set]', at=None, as_list=False):
 	# can compare to a well known order.
 	return "; ".join(sorted(str(r).rstrip('.') for r in response))
 
+def query_mta_sts_policy(domain):
+	# Returns the domain's MTA-STS (result, policy), from the DNS answer cache
+	# if run_domain_checks has already fetched it.
+	key = get_dns_query_key(domain, "MTA-STS")
+	cache = getattr(_dns_answers, "cache", None)
+	try:
+		if cache is None: raise KeyError # fetch it below
+		response = cache.get(key)
+		cache.hits += 1
+	except KeyError:
+		loop = asyncio.new_event_loop()
+		try:
+			sts_resolver = postfix_mta_sts_resolver.resolver.STSResolver(loop=loop)
+			response = list(loop.run_until_complete(sts_resolver.resolve(domain)))
+		finally:
+			loop.close()
+		if cache is not None:
+			cache.misses += 1
+			cache.add(key, response, MTA_STS_POLICY_TTL)
+	return response
+
 def check_ssl_cert(domain, rounded_time, ssl_certificates, env, output):
 	# Check that TLS certificate is signed.
 
@@ -1009,7 +1399,7 @@ def check_miab_version(env, output):
 		else:
 			output.print_error(f"A new version of Mail-in-a-Box is available. You are running version {this_ver}. The latest version is {latest_ver}. For upgrade instructions, see https://mailinabox.email. ")
 
-def run_and_output_changes(env, pool):
+def run_and_output_changes(env, pool, verbose=False, incremental=False, force=False):
 	import json
 	from difflib import SequenceMatcher
 
@@ -1017,7 +1407,7 @@ def run_and_output_changes(env, pool):
 
 	# Run status checks.
 	cur = BufferedOutput()
-	run_checks(True, env, cur, pool)
+	run_checks(True, env, cur, pool, verbose=verbose, incremental=incremental, force=force)
 
 	# Load previously saved status checks.
 	cache_fn = "/var/cache/mailinabox/status_checks.json"
@@ -1170,13 +1560,22 @@ if __name__ == "__main__":
 
 	env = load_environment()
 
+	# --verbose reports statistics about the checks on stderr. --incremental
+	# reuses the saved results of the checks for domains where nothing they
+	# depend on has changed, and --force checks every domain anyway.
+	options = { }
+	for option in ("verbose", "incremental", "force"):
+		options[option] = "--" + option in sys.argv[1:]
+		if options[option]:
+			sys.argv.remove("--" + option)
+
 	if len(sys.argv) == 1:
 		with multiprocessing.pool.Pool(processes=10) as pool:
-			run_checks(False, env, ConsoleOutput(), pool)
+			run_checks(False, env, ConsoleOutput(), pool, **options)
 
 	elif sys.argv[1] == "--show-changes":
 		with multiprocessing.pool.Pool(processes=10) as pool:
-			run_and_output_changes(env, pool)
+			run_and_output_changes(env, pool, **options)
 
 	elif sys.argv[1] == "--check-primary-hostname":
 		# See if the primary hostname appears resolvable and has a signed certificate.
@@ -1197,4 +1596,4 @@ if __name__ == "__main__":
 
 	elif sys.argv[1] == "--only":
 		with multiprocessing.pool.Pool(processes=10) as pool:
-			run_checks(False, env, ConsoleOutput(), pool, domains_to_check=sys.argv[2:])
+			run_checks(False, env, ConsoleOutput(), pool, domains_to_check=sys.argv[2:], **options)
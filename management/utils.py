@@ -1,4 +1,4 @@
-import os.path
+import collections, contextlib, os.path, threading
 
 # DO NOT import non-standard modules. This module is imported by
 # migrate.py which runs on fresh machines before anything is installed
@@ -23,6 +23,47 @@ def save_environment(env):
     with open("/etc/mailinabox.conf", "w", encoding="utf-8") as f:
         f.writelines(f"{k}={v}\n" for k, v in env.items())
 
+# CONFIGURATION SNAPSHOTS
+
+class ConfigSnapshot(collections.OrderedDict):
+    # An env that also remembers the mail users, aliases, domains, custom DNS
+    # records, etc. the first time each is looked up, so that one operation
+    # (like updating DNS and nginx after a change) reads the database and the
+    # configuration files once rather than every time they are needed. Use a
+    # new snapshot for each operation, since it doesn't see later changes.
+    def __init__(self, env=()):
+        super().__init__(env)
+        self.memo = { }
+
+    def __reduce__(self):
+        # Don't send the remembered values to other processes.
+        return (self.__class__, (list(self.items()),))
+
+def config_snapshot(env):
+    # Returns a snapshot of env, or env itself if it's already a snapshot
+    # so that an operation run as part of another shares its snapshot.
+    if isinstance(env, ConfigSnapshot):
+        return env
+    return ConfigSnapshot(env)
+
+def memoized(env, key, func):
+    # Returns func(), remembering the value in env if env is a ConfigSnapshot.
+    # Callers must not modify the returned value.
+    memo = getattr(env, "memo", None)
+    if memo is None:
+        return func()
+    if key not in memo:
+        memo[key] = func()
+    return memo[key]
+
+def forget_memoized(env, *keys):
+    # Forget values remembered by memoized after changing what they were made from.
+    memo = getattr(env, "memo", None)
+    if memo is not None:
+        for key in list(memo):
+            if key in keys or (isinstance(key, tuple) and key[0] in keys):
+                del memo[key]
+
 # THE SETTINGS FILE AT STORAGE_ROOT/settings.yaml.
 
 def write_settings(config, env):
@@ -49,6 +90,45 @@ def safe_domain_name(name):
     import urllib.parse
     return urllib.parse.quote(name, safe='')
 
+class DomainSuffixIndex:
+    # A set of domain names stored as a trie keyed on their labels from right
+    # to left (com -> example -> www), for finding which of the domain names
+    # is a given domain or one of its parent domains. Lookups take time
+    # proportional to the number of labels in the domain being looked up,
+    # not to the number of domains in the index.
+
+    def __init__(self, domains=()):
+        self.root = { }
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain):
+        node = self.root
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, { })
+        node[None] = domain # labels are never None, so mark the end with it
+
+    def __contains__(self, domain):
+        node = self.root
+        for label in reversed(domain.split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+        return None in node
+
+    def find(self, domain, include_self=True):
+        # Returns the top-most domain in the index that is the domain itself
+        # (unless include_self is False) or one of its parent domains, or None.
+        node = self.root
+        labels = domain.split(".")
+        for i, label in enumerate(reversed(labels)):
+            node = node.get(label)
+            if node is None:
+                return None
+            if None in node and (include_self or i < len(labels) - 1):
+                return node[None]
+        return None
+
 def sort_domains(domain_names, env):
     # Put domain names in a nice sorted order.
 
@@ -58,19 +138,19 @@ def sort_domains(domain_names, env):
     # from shortest to longest since zones are always shorter than their
     # subdomains.
     zones = { }
+    zone_roots = DomainSuffixIndex()
     for domain in sorted(domain_names, key=len):
-        for z in zones.values():
-            if domain.endswith("." + z):
-                # We found a parent domain already in the list.
-                zones[domain] = z
-                break
+        parent = zone_roots.find(domain, include_self=False)
+        if parent is not None:
+            # We found a parent domain already in the list.
+            zones[domain] = parent
         else:
-            # 'break' did not occur: there is no parent domain, so it is its
-            # own zone.
+            # There is no parent domain, so it is its own zone.
             zones[domain] = domain
+            zone_roots.add(domain)
 
     # Sort the zones.
-    zone_domains = sorted(zones.values(),
+    zone_domains = sorted(set(zones.values()),
       key = lambda d : (
         # PRIMARY_HOSTNAME or the zone that contains it is always first.
         not (d == env['PRIMARY_HOSTNAME'] or env['PRIMARY_HOSTNAME'].endswith("." + d)),
@@ -78,12 +158,13 @@ def sort_domains(domain_names, env):
         # Then just dumb lexicographically.
         d,
       ))
+    zone_order = { zone: i for i, zone in enumerate(zone_domains) }
 
     # Now sort the domain names that fall within each zone.
     return sorted(domain_names,
       key = lambda d : (
         # First by zone.
-        zone_domains.index(zones[d]),
+        zone_order[zones[d]],
 
         # PRIMARY_HOSTNAME is always first within the zone that contains it.
         d != env['PRIMARY_HOSTNAME'],
@@ -97,16 +178,93 @@ def sort_domains(domain_names, env):
 
 
 def sort_email_addresses(email_addresses, env):
-    email_addresses = set(email_addresses)
-    domains = {email.split("@", 1)[1] for email in email_addresses if "@" in email}
+    # Group the addresses by domain, then put the domains in sort_domains order
+    # and the addresses within each domain in lexicographic order.
+    by_domain = { }
+    no_domain = [ ]
+    for email in set(email_addresses):
+        if "@" in email:
+            by_domain.setdefault(email.split("@", 1)[1], []).append(email)
+        else:
+            no_domain.append(email)
     ret = []
-    for domain in sort_domains(domains, env):
-        domain_emails = {email for email in email_addresses if email.endswith("@" + domain)}
-        ret.extend(sorted(domain_emails))
-        email_addresses -= domain_emails
-    ret.extend(sorted(email_addresses)) # whatever is left
+    for domain in sort_domains(by_domain, env):
+        ret.extend(sorted(by_domain[domain]))
+    ret.extend(sorted(no_domain)) # whatever is left
     return ret
 
+def write_file_atomic(fn, content, mode=0o644):
+    # Write a text file so that anything reading it sees either the old file
+    # or the new one but never a partially written one: write a temporary
+    # file in the same directory, flush it to disk, and rename it over the
+    # file. The file keeps its permissions, or gets mode if it's new.
+    import stat, tempfile
+    try:
+        mode = stat.S_IMODE(os.stat(fn).st_mode)
+    except FileNotFoundError:
+        pass
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix="." + os.path.basename(fn) + ".")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_fn, mode)
+        os.replace(tmp_fn, fn)
+    except:
+        os.unlink(tmp_fn)
+        raise
+
+def write_file_if_changed(fn, content, mode=0o644):
+    # Write a text file with write_file_atomic unless it already has the
+    # given content. Returns whether the file was written.
+    try:
+        with open(fn, encoding="utf-8") as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    write_file_atomic(fn, content, mode=mode)
+    return True
+
+# LOCKS
+
+# The management daemon runs several worker processes. Operations that
+# rewrite the box's configuration (DNS zones, nginx, certificates, etc.) hold
+# this lock so that only one runs at a time across all of them.
+UPDATE_LOCK_FILE = "/var/lib/mailinabox/update.lock"
+
+_held_file_locks = threading.local()
+
+@contextlib.contextmanager
+def file_lock(fn):
+    # Hold an exclusive lock on the file fn, which is created if needed, until
+    # the end of the with block. Other processes and other threads wait for
+    # it. A thread that already holds the lock may take it again, so that
+    # locked operations can call each other. This can also be used as a
+    # function decorator.
+    import fcntl
+    held = _held_file_locks.__dict__.setdefault("held", { })
+    if held.get(fn):
+        held[fn] += 1
+        try:
+            yield
+        finally:
+            held[fn] -= 1
+        return
+    with open(fn, "a", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        held[fn] = 1
+        try:
+            yield
+        finally:
+            held[fn] = 0
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def update_lock():
+    # See UPDATE_LOCK_FILE.
+    return file_lock(UPDATE_LOCK_FILE)
+
 def shell(method, cmd_args, env=None, capture_stderr=False, return_bytes=False, trap=False, input=None):
     # A safe way to execute processes.
     # Some processes like apt-get require being given a sane PATH.
@@ -7,9 +7,13 @@ import os.path, re, rtyaml
 from mailconfig import get_mail_domains
 from dns_update import get_custom_dns_config, get_dns_zones
 from ssl_certificates import get_ssl_certificates, get_domain_ssl_files, check_certificate
-from utils import shell, safe_domain_name, sort_domains
+from utils import shell, safe_domain_name, sort_domains, config_snapshot, memoized, update_lock
 
 def get_web_domains(env, include_www_redirects=True, include_auto=True, exclude_dns_elsewhere=True):
+	return list(memoized(env, ("web_domains", include_www_redirects, include_auto, exclude_dns_elsewhere),
+		lambda: query_web_domains(env, include_www_redirects, include_auto, exclude_dns_elsewhere)))
+
+def query_web_domains(env, include_www_redirects, include_auto, exclude_dns_elsewhere):
 	# What domains should we serve HTTP(S) for?
 	domains = set()
 
@@ -71,7 +75,11 @@ def get_web_domains_with_root_overrides(env):
 					root_overrides[domain] = (type, value)
 	return root_overrides
 
+@update_lock()
 def do_web_update(env):
+	# Look up users, aliases, domains, etc. once for the whole update.
+	env = config_snapshot(env)
+
 	# Pre-load what SSL certificates we will use for each domain.
 	ssl_certificates = get_ssl_certificates(env)
 
@@ -242,6 +250,7 @@ def get_web_root(domain, env, test_exists=True):
 	return root
 
 def get_web_domains_info(env):
+	env = config_snapshot(env)
 	www_redirects = set(get_web_domains(env)) - set(get_web_domains(env, include_www_redirects=False))
 	has_root_proxy_or_redirect = set(get_web_domains_with_root_overrides(env))
 	ssl_certificates = get_ssl_certificates(env)
@@ -86,7 +86,12 @@ rm -f /tmp/bootstrap.zip
 # running after a reboot.
 # Set a long timeout since some commands take a while to run, matching
 # the timeout we set for PHP (fastcgi_read_timeout in the nginx confs).
-# Note: Authentication currently breaks with more than 1 gunicorn worker.
+# Run several workers so that a long-running request, like the status
+# checks, doesn't hold up everyone else. Changes to the box's configuration
+# are made one at a time across workers (see update_lock in
+# management/utils.py). Login sessions are shared between
+# workers in /var/lib/mailinabox/sessions.sqlite, which is cleared here
+# because a new API key invalidates all existing sessions anyway.
 cat > $inst_dir/start <<EOF;
 #!/bin/bash
 # Set character encoding flags to ensure that any non-ASCII don't cause problems.
@@ -98,10 +103,11 @@ export LC_TYPE=en_US.UTF-8
 mkdir -p /var/lib/mailinabox
 tr -cd '[:xdigit:]' < /dev/urandom | head -c 32 > /var/lib/mailinabox/api.key
 chmod 640 /var/lib/mailinabox/api.key
+rm -f /var/lib/mailinabox/sessions.sqlite*
 
 source $venv/bin/activate
 export PYTHONPATH=$PWD/management
-exec gunicorn -b 127.0.0.1:10222 -w 1 --timeout 630 wsgi:app
+exec gunicorn -c $PWD/management/gunicorn_conf.py -b 127.0.0.1:10222 -w 4 --timeout 630 wsgi:app
 EOF
 chmod +x $inst_dir/start
 cp --remove-destination conf/mailinabox.service /lib/systemd/system/mailinabox.service # target was previously a symlink so remove it first
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmarks for management code that has to scale to boxes with
+# thousands of domains and tens of thousands of addresses. These run on
+# synthetic data and don't need a Mail-in-a-Box.
+#
+# tests/benchmark.py [benchmark ...]
+#
+# With no arguments, all benchmarks are run.
+
+import os, random, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+
+import utils
+
+PRIMARY_HOSTNAME = "box.example.com"
+
+def make_domains(count, rand):
+	# A mix of zones and subdomains within them, like a box with many customer domains.
+	domains = { PRIMARY_HOSTNAME, "example.com" }
+	while len(domains) < count:
+		zone = f"customer{rand.randrange(count // 3)}.{rand.choice(['com', 'net', 'org', 'co.uk'])}"
+		domains.add(zone)
+		if rand.random() < .5:
+			domains.add(rand.choice(["www", "mail", "autoconfig", "mta-sts"]) + "." + zone)
+	return sorted(domains)
+
+def make_addresses(domains, count, rand):
+	domains = list(domains)
+	return [f"user{i}@{rand.choice(domains)}" for i in range(count)]
+
+def timeit(description, func, repeat=3):
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		func()
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	print(f"{description:<50} {best*1000:10.1f} ms")
+
+def bench_sort_domains():
+	rand = random.Random(0)
+	env = { "PRIMARY_HOSTNAME": PRIMARY_HOSTNAME }
+	for count in (300, 3000, 10000):
+		domains = make_domains(count, rand)
+		timeit(f"sort_domains({count} domains)", lambda domains=domains: utils.sort_domains(domains, env))
+
+def bench_sort_email_addresses():
+	rand = random.Random(0)
+	env = { "PRIMARY_HOSTNAME": PRIMARY_HOSTNAME }
+	domains = make_domains(3000, rand)
+	for count in (4000, 40000):
+		addresses = make_addresses(domains, count, rand)
+		timeit(f"sort_email_addresses({count} addresses)", lambda addresses=addresses: utils.sort_email_addresses(addresses, env))
+
+def make_custom_records(zone, count, rand):
+	# Custom DNS records on many subdomains of a zone, some of which override
+	# records the box would otherwise set.
+	records = []
+	for i in range(count):
+		qname = rand.choice([zone, f"host{i % (count // 4 + 1)}.{zone}", f"_dmarc.host{i}.{zone}"])
+		rtype = rand.choice(["A", "AAAA", "TXT", "TXT", "MX", "CNAME", "SRV"])
+		records.append((qname, rtype, "local" if rtype in {"A", "AAAA"} else f"value {i}"))
+	return records
+
+def bench_build_zone():
+	import dns_update
+	rand = random.Random(0)
+	zone = "example.net"
+	with tempfile.TemporaryDirectory() as storage_root:
+		os.makedirs(os.path.join(storage_root, "mail/dkim"))
+		with open(os.path.join(storage_root, "mail/dkim/mail.txt"), "w", encoding="utf-8") as f:
+			f.write('mail._domainkey\tIN\tTXT\t( "v=DKIM1; h=sha256; k=rsa; s=email; " "p=MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA" )  ; ----- DKIM key mail for example.net\n')
+		env = { "PRIMARY_HOSTNAME": PRIMARY_HOSTNAME, "PUBLIC_IP": "192.0.2.1", "PUBLIC_IPV6": "2001:db8::1", "STORAGE_ROOT": storage_root }
+		domain_properties = {
+			domain: { "user": True, "mail": True, "web": True, "auto": False, "certificate-is-valid": False }
+			for domain in (zone, "www." + zone, "mail." + zone, PRIMARY_HOSTNAME)
+		}
+		for count in (500, 5000):
+			records = dns_update.CustomDNSRecords(make_custom_records(zone, count, rand))
+			timeit(f"build_zone({count} custom records)", lambda records=records: dns_update.build_zone(zone, domain_properties, records, env))
+
+BENCHMARKS = {
+	"sort_domains": bench_sort_domains,
+	"sort_email_addresses": bench_sort_email_addresses,
+	"build_zone": bench_build_zone,
+}
+
+if __name__ == "__main__":
+	names = sys.argv[1:] or list(BENCHMARKS)
+	for name in names:
+		if name not in BENCHMARKS:
+			print(f"Unknown benchmark {name}. Choose from: {', '.join(BENCHMARKS)}")
+			sys.exit(1)
+		BENCHMARKS[name]()